@@ -22,7 +22,460 @@ Last modified: September 2020
 '''
 
 # Import required packages
+import dask
+import numexpr
 import warnings
+import numpy as np
+import xarray as xr
+import dask.array as da
+from collections import Counter
+
+
+def _mask_nodata(ds):
+    """
+    Sets pixels equal to a band's `nodata` attribute to NaN for any
+    integer bands (e.g. data loaded using `load_ard(..., dtype='native')`),
+    so that nodata or masked pixels are not included in index
+    calculations. Bands that are already floating point are returned
+    unchanged.
+    """
+    for band in ds.data_vars:
+        nodata = ds[band].attrs.get('nodata')
+        if nodata is not None and np.issubdtype(ds[band].dtype, np.integer):
+            ds[band] = ds[band].where(ds[band] != nodata)
+    return ds
+
+
+# Dictionary containing remote sensing index band recipes
+_INDEX_DICT = {
+              # Normalised Difference Vegation Index, Rouse 1973
+              'NDVI': lambda ds: (ds.nir - ds.red) /
+                                 (ds.nir + ds.red),
+
+              # Enhanced Vegetation Index, Huete 2002
+              'EVI': lambda ds: ((2.5 * (ds.nir - ds.red)) /
+                                 (ds.nir + 6 * ds.red -
+                                  7.5 * ds.blue + 1)),
+
+              # Leaf Area Index, Boegh 2002
+              'LAI': lambda ds: (3.618 * ((2.5 * (ds.nir - ds.red)) /
+                                 (ds.nir + 6 * ds.red -
+                                  7.5 * ds.blue + 1)) - 0.118),
+
+              # Soil Adjusted Vegetation Index, Huete 1988
+              'SAVI': lambda ds: ((1.5 * (ds.nir - ds.red)) /
+                                  (ds.nir + ds.red + 0.5)),
+  
+              # Mod. Soil Adjusted Vegetation Index, Qi et al. 1994
+              'MSAVI': lambda ds: ((2 * ds.nir + 1 - 
+                                  ((2 * ds.nir + 1)**2 - 
+                                   8 * (ds.nir - ds.red))**0.5) / 2),    
+
+              # Normalised Difference Moisture Index, Gao 1996
+              'NDMI': lambda ds: (ds.nir - ds.swir1) /
+                                 (ds.nir + ds.swir1),
+
+              # Normalised Burn Ratio, Lopez Garcia 1991
+              'NBR': lambda ds: (ds.nir - ds.swir2) /
+                                (ds.nir + ds.swir2),
+
+              # Burn Area Index, Martin 1998
+              'BAI': lambda ds: (1.0 / ((0.10 - ds.red) ** 2 +
+                                        (0.06 - ds.nir) ** 2)),
+    
+             # Normalised Difference Chlorophyll Index, 
+             # (Mishra & Mishra, 2012)
+              'NDCI': lambda ds: (ds.red_edge_1 - ds.red) /
+                                 (ds.red_edge_1 + ds.red),
+
+              # Normalised Difference Snow Index, Hall 1995
+              'NDSI': lambda ds: (ds.green - ds.swir1) /
+                                 (ds.green + ds.swir1),
+
+              # Normalised Difference Tillage Index,
+              # Van Deventer et al. 1997
+              'NDTI': lambda ds: (ds.swir1 - ds.swir2) /
+                                 (ds.swir1 + ds.swir2),
+
+              # Normalised Difference Water Index, McFeeters 1996
+              'NDWI': lambda ds: (ds.green - ds.nir) /
+                                 (ds.green + ds.nir),
+
+              # Modified Normalised Difference Water Index, Xu 2006
+              'MNDWI': lambda ds: (ds.green - ds.swir1) /
+                                  (ds.green + ds.swir1),
+  
+              # Normalised Difference Built-Up Index, Zha 2003
+              'NDBI': lambda ds: (ds.swir1 - ds.nir) /
+                                 (ds.swir1 + ds.nir),
+  
+              # Built-Up Index, He et al. 2010
+              'BUI': lambda ds:  ((ds.swir1 - ds.nir) /
+                                  (ds.swir1 + ds.nir)) -
+                                 ((ds.nir - ds.red) /
+                                  (ds.nir + ds.red)),
+  
+              # Built-up Area Extraction Index, Bouzekri et al. 2015
+              'BAEI': lambda ds: (ds.red + 0.3) /
+                                 (ds.green + ds.swir1),
+  
+              # New Built-up Index, Jieli et al. 2010
+              'NBI': lambda ds: (ds.swir1 + ds.red) / ds.nir,
+  
+              # Bare Soil Index, Rikimaru et al. 2002
+              'BSI': lambda ds: ((ds.swir1 + ds.red) - 
+                                 (ds.nir + ds.blue)) / 
+                                ((ds.swir1 + ds.red) + 
+                                 (ds.nir + ds.blue)),
+
+              # Automated Water Extraction Index (no shadows), Feyisa 2014
+              'AWEI_ns': lambda ds: (4 * (ds.green - ds.swir1) -
+                                    (0.25 * ds.nir * + 2.75 * ds.swir2)),
+
+              # Automated Water Extraction Index (shadows), Feyisa 2014
+              'AWEI_sh': lambda ds: (ds.blue + 2.5 * ds.green -
+                                     1.5 * (ds.nir + ds.swir1) -
+                                     0.25 * ds.swir2),
+
+              # Water Index, Fisher 2016
+              'WI': lambda ds: (1.7204 + 171 * ds.green + 3 * ds.red -
+                                70 * ds.nir - 45 * ds.swir1 -
+                                71 * ds.swir2),
+
+              # Tasseled Cap Wetness, Crist 1985
+              'TCW': lambda ds: (0.0315 * ds.blue + 0.2021 * ds.green +
+                                 0.3102 * ds.red + 0.1594 * ds.nir +
+                                -0.6806 * ds.swir1 + -0.6109 * ds.swir2),
+
+              # Tasseled Cap Greeness, Crist 1985
+              'TCG': lambda ds: (-0.1603 * ds.blue + -0.2819 * ds.green +
+                                 -0.4934 * ds.red + 0.7940 * ds.nir +
+                                 -0.0002 * ds.swir1 + -0.1446 * ds.swir2),
+
+              # Tasseled Cap Brightness, Crist 1985
+              'TCB': lambda ds: (0.2043 * ds.blue + 0.4158 * ds.green +
+                                 0.5524 * ds.red + 0.5741 * ds.nir +
+                                 0.3124 * ds.swir1 + -0.2303 * ds.swir2),
+
+              # Clay Minerals Ratio, Drury 1987
+              'CMR': lambda ds: (ds.swir1 / ds.swir2),
+
+              # Ferrous Minerals Ratio, Segal 1982
+              'FMR': lambda ds: (ds.swir1 / ds.nir),
+
+              # Iron Oxide Ratio, Segal 1982
+              'IOR': lambda ds: (ds.red / ds.blue)
+}
+
+
+# Dictionaries mapping full data names to simpler 'red' alias names for
+# each collection. GA Landsat Collection 2 bands do not need renaming
+_BANDNAMES_DICT = {
+    'ga_ls_3': {
+        'nbart_nir': 'nir',
+        'nbart_red': 'red',
+        'nbart_green': 'green',
+        'nbart_blue': 'blue',
+        'nbart_swir_1': 'swir1',
+        'nbart_swir_2': 'swir2',
+        'nbar_red': 'red',
+        'nbar_green': 'green',
+        'nbar_blue': 'blue',
+        'nbar_nir': 'nir',
+        'nbar_swir_1': 'swir1',
+        'nbar_swir_2': 'swir2'
+    },
+    'ga_s2_1': {
+        'nbart_red': 'red',
+        'nbart_green': 'green',
+        'nbart_blue': 'blue',
+        'nbart_nir_1': 'nir',
+        'nbart_red_edge_1': 'red_edge_1',
+        'nbart_red_edge_2': 'red_edge_2',
+        'nbart_swir_2': 'swir1',
+        'nbart_swir_3': 'swir2',
+        'nbar_red': 'red',
+        'nbar_green': 'green',
+        'nbar_blue': 'blue',
+        'nbar_nir_1': 'nir',
+        'nbar_red_edge_1': 'red_edge_1',
+        'nbar_red_edge_2': 'red_edge_2',
+        'nbar_swir_2': 'swir1',
+        'nbar_swir_3': 'swir2'
+    },
+    'ga_ls_2': {}
+}
+
+
+def _binary_op(op, reflected=False):
+    """
+    Creates an operator method for `_Expression` that records a binary
+    operation instead of evaluating it.
+    """
+    def method(self, other):
+        if not isinstance(other, _Expression):
+            other = _Expression('const', other)
+        return (_Expression(op, other, self) if reflected else
+                _Expression(op, self, other))
+    return method
+
+
+class _Expression:
+    """
+    A node in a symbolic expression tree. Index recipes in `_INDEX_DICT`
+    are traced by applying them to `_BandTracer` (in place of a
+    Dataset), which records the band arithmetic they perform so that
+    many indices can be compiled into a single fused kernel.
+    """
+
+    def __init__(self, op, *args):
+        self.op = op
+        self.args = args
+        if op in ('band', 'const'):
+            self.key = (op, args[0])
+        else:
+            self.key = (op,) + tuple(arg.key for arg in args)
+
+    __add__ = _binary_op('+')
+    __radd__ = _binary_op('+', reflected=True)
+    __sub__ = _binary_op('-')
+    __rsub__ = _binary_op('-', reflected=True)
+    __mul__ = _binary_op('*')
+    __rmul__ = _binary_op('*', reflected=True)
+    __truediv__ = _binary_op('/')
+    __rtruediv__ = _binary_op('/', reflected=True)
+    __pow__ = _binary_op('**')
+    __rpow__ = _binary_op('**', reflected=True)
+
+    def __neg__(self):
+        return _Expression('neg', self)
+
+    def __pos__(self):
+        return self
+
+    def bands(self):
+        """Returns the set of band names used by the expression."""
+        if self.op == 'band':
+            return {self.args[0]}
+        if self.op == 'const':
+            return set()
+        return set.union(*(arg.bands() for arg in self.args))
+
+    def to_string(self, names):
+        """
+        Returns the expression as a numexpr string, substituting the
+        variable names in `names` (keyed by node) for bands and any
+        hoisted subexpressions.
+        """
+        if self.key in names:
+            return names[self.key]
+        if self.op == 'const':
+            return repr(float(self.args[0]))
+        if self.op == 'neg':
+            return f'(-{self.args[0].to_string(names)})'
+        left, right = (arg.to_string(names) for arg in self.args)
+        return f'({left} {self.op} {right})'
+
+
+class _BandTracer:
+    """
+    A stand-in for a Dataset of renamed bands that returns a symbolic
+    `_Expression` for any band accessed as an attribute (e.g. `ds.nir`).
+    """
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _Expression('band', name)
+
+
+def _trace_indices(indices):
+    """
+    Traces a list of index recipes, returning a dictionary of their
+    expression trees and the set of (renamed) bands they require.
+    """
+    expressions = {index: _INDEX_DICT[index](_BandTracer())
+                   for index in indices}
+    bands = set().union(*(expr.bands() for expr in expressions.values()))
+    return expressions, sorted(bands)
+
+
+def _compile_indices(expressions, bands):
+    """
+    Compiles traced index expressions into numexpr strings. Any
+    subexpression shared between indices (e.g. `nir - red` in NDVI,
+    SAVI and BUI) or repeated within an index is hoisted into a
+    temporary variable so that it is evaluated only once.
+
+    Returns a list of (name, expression) temporaries in the order they
+    must be evaluated, and a list of output index expressions.
+    """
+
+    # Count references to each subexpression, only descending into a
+    # subexpression the first time it is seen so that its children are
+    # not counted again for each repeat. Post-order gives an evaluation
+    # order where subexpressions come before the expressions using them
+    counts = Counter()
+    order = []
+
+    def visit(node):
+        if node.op in ('band', 'const'):
+            return
+        counts[node.key] += 1
+        if counts[node.key] == 1:
+            for arg in node.args:
+                visit(arg)
+            order.append(node)
+
+    for expr in expressions.values():
+        visit(expr)
+
+    # Hoist repeated subexpressions (excluding the index outputs
+    # themselves) into temporaries
+    names = {('band', band): band for band in bands}
+    temporaries = []
+    for node in order:
+        if counts[node.key] > 1:
+            temporaries.append((f'_t{len(temporaries)}',
+                                node.to_string(names)))
+            names[node.key] = temporaries[-1][0]
+
+    outputs = [expr.to_string(names) for expr in expressions.values()]
+    return temporaries, outputs
+
+
+def _encode_block(array, dtype, scale_factor=0.0001):
+    """
+    Encodes a block of floating point index values as a reduced
+    precision dtype. For integer dtypes, values are divided by
+    `scale_factor`, rounded and clipped to the valid range of the
+    dtype, and NaN values are set to the dtype's minimum value.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return array.astype(dtype)
+
+    info = np.iinfo(dtype)
+    scaled = np.rint(array / scale_factor)
+    np.clip(scaled, info.min + 1, info.max, out=scaled)
+    scaled[np.isnan(scaled)] = info.min
+    return scaled.astype(dtype)
+
+
+def _encoding_attrs(dtype, scale_factor=0.0001):
+    """
+    Returns CF-style attributes describing how index values are
+    encoded, so that they are decoded correctly when written to and
+    read from file (e.g. using `xr.open_dataset`).
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return {}
+    fill_value = int(np.iinfo(dtype).min)
+    return {'scale_factor': scale_factor,
+            'add_offset': 0.0,
+            '_FillValue': fill_value,
+            'nodata': fill_value}
+
+
+def _fused_index_block(*arrays, bands, nodata, mult, temporaries,
+                       outputs, calc_dtype, out_dtype=None,
+                       scale_factor=0.0001):
+    """
+    Computes a set of compiled index expressions for a single block of
+    data, returning the indices stacked along a new first axis. Each
+    input band is masked and normalised only once. If `out_dtype` is
+    provided, each index is encoded to this dtype as it is computed.
+    """
+
+    # Normalise and mask each band once. Integer bands with a nodata
+    # value are converted to float as in `_mask_nodata`
+    local_dict = {}
+    for band, array, band_nodata in zip(bands, arrays, nodata):
+        if band_nodata is not None and np.issubdtype(array.dtype,
+                                                     np.integer):
+            masked = array.astype(np.float32 if array.dtype.itemsize <= 2
+                                  else np.float64)
+            masked[array == band_nodata] = np.nan
+            array = masked
+        local_dict[band] = array / mult
+
+    # Evaluate shared subexpressions, then each index
+    shape = arrays[0].shape
+    for name, expr in temporaries:
+        local_dict[name] = numexpr.evaluate(
+            expr, local_dict=local_dict,
+            out=np.empty(shape, dtype=calc_dtype), casting='same_kind')
+
+    out = np.empty((len(outputs),) + shape,
+                   dtype=out_dtype or calc_dtype)
+    scratch = np.empty(shape, dtype=calc_dtype) if out_dtype else None
+    for i, expr in enumerate(outputs):
+        if out_dtype is None:
+            numexpr.evaluate(expr, local_dict=local_dict, out=out[i],
+                             casting='same_kind')
+        else:
+            numexpr.evaluate(expr, local_dict=local_dict, out=scratch,
+                             casting='same_kind')
+            out[i] = _encode_block(scratch, out_dtype, scale_factor)
+
+    return out
+
+
+def _calculate_indices_fused(ds, indices, mult, dtype=None,
+                             scale_factor=0.0001):
+    """
+    Calculates a list of indices from a Dataset of renamed bands using
+    a single fused numexpr kernel, applied block-by-block for dask
+    arrays. Returns a dictionary of index DataArrays, optionally
+    encoded as `dtype`.
+    """
+
+    expressions, bands = _trace_indices(indices)
+    temporaries, outputs = _compile_indices(expressions, bands)
+
+    # Output dtype matches that of evaluating indices with xarray
+    nodata = [ds[band].attrs.get('nodata') for band in bands]
+    band_dtypes = []
+    for band, band_nodata in zip(bands, nodata):
+        band_dtype = ds[band].dtype
+        if band_nodata is not None and np.issubdtype(band_dtype,
+                                                     np.integer):
+            band_dtype = (np.float32 if band_dtype.itemsize <= 2
+                          else np.float64)
+        band_dtypes.append((np.empty(0, dtype=band_dtype) / mult).dtype)
+    calc_dtype = np.result_type(*band_dtypes)
+    out_dtype = np.dtype(dtype) if dtype else calc_dtype
+
+    kwargs = dict(bands=bands, nodata=nodata, mult=mult,
+                  temporaries=temporaries, outputs=outputs,
+                  calc_dtype=calc_dtype,
+                  out_dtype=np.dtype(dtype) if dtype else None,
+                  scale_factor=scale_factor)
+    template = ds[bands[0]]
+    arrays = [ds[band].data for band in bands]
+
+    if any(dask.is_dask_collection(array) for array in arrays):
+        chunks = next(array.chunks for array in arrays
+                      if dask.is_dask_collection(array))
+        arrays = [da.asarray(array).rechunk(chunks) for array in arrays]
+        stacked = da.map_blocks(_fused_index_block,
+                                *arrays,
+                                new_axis=0,
+                                chunks=((len(outputs),),) + arrays[0].chunks,
+                                dtype=out_dtype,
+                                meta=np.array((), dtype=out_dtype),
+                                **kwargs)
+    else:
+        stacked = _fused_index_block(*arrays, **kwargs)
+
+    return {index: xr.DataArray(stacked[i],
+                                coords=template.coords,
+                                dims=template.dims,
+                                attrs=_encoding_attrs(out_dtype,
+                                                      scale_factor))
+            for i, index in enumerate(indices)}
+
 
 # Define custom functions
 def calculate_indices(ds,
@@ -31,15 +484,19 @@ def calculate_indices(ds,
                       custom_varname=None,
                       normalise=True,
                       drop=False,
-                      inplace=False):
+                      inplace=False,
+                      fused=False,
+                      dtype=None,
+                      scale_factor=0.0001):
     """
     Takes an xarray dataset containing spectral bands, calculates one of
     a set of remote sensing indices, and adds the resulting array as a 
     new variable in the original dataset.  
     
-    Note: by default, this function will create a new copy of the data
-    in memory. This can be a memory-expensive operation, so to avoid
-    this, set `inplace=True`.
+    Note: by default, this function returns a new dataset rather than
+    modifying `ds`. This does not copy the input bands: the returned
+    dataset references the same underlying data as `ds`, and only the
+    bands required by the selected indices are read.
 
     Last modified: September 2020
     
@@ -48,7 +505,10 @@ def calculate_indices(ds,
     ds : xarray Dataset
         A two-dimensional or multi-dimensional array with containing the
         spectral bands required to calculate the index. These bands are
-        used as inputs to calculate the selected water index.
+        used as inputs to calculate the selected water index. Bands can
+        be supplied in their native integer dtype (e.g. as returned by
+        `load_ard(..., dtype='native')`); in this case, pixels equal to
+        each band's `nodata` attribute will be treated as NaN.
     index : str or list of strs
         A string giving the name of the index to calculate or a list of
         strings giving the names of the indices to calculate:
@@ -110,8 +570,34 @@ def calculate_indices(ds,
     inplace: bool, optional
         If `inplace=True`, calculate_indices will modify the original
         array in-place, adding bands to the input dataset. The default
-        is `inplace=False`, which will instead make a new copy of the
-        original data (and use twice the memory).
+        is `inplace=False`, which will instead return a new dataset
+        that references (but does not copy) the original data.
+    fused : bool, optional
+        If `fused=True`, all requested indices are compiled into a
+        single numexpr kernel that is evaluated block-by-block. Each
+        input band is masked and normalised only once, and
+        subexpressions shared between indices (e.g. `nir + red` in
+        both 'NDVI' and 'BUI') are only computed once, avoiding the
+        many temporary arrays created by evaluating each index with
+        xarray. This makes calculating many indices at once not much
+        more expensive than calculating one. Defaults to False.
+    dtype : str, optional
+        An optional reduced precision dtype in which to return indices,
+        to reduce memory use and file sizes. Valid options are
+        'float16', or 'int16' which encodes index values as integers
+        scaled by `scale_factor`. Integer outputs have CF-style
+        `scale_factor`, `add_offset`, `_FillValue` and `nodata`
+        attributes, so values are decoded back to floating point (with
+        NaN for nodata) when exported and re-read using e.g. NetCDF or
+        GeoTIFF. Defaults to None, which returns indices as float32 (or
+        float64 if the input bands are float64).
+    scale_factor : float, optional
+        The scale factor used to encode indices if `dtype='int16'`.
+        The default of 0.0001 preserves four decimal places, and can
+        represent values between -3.2767 and 3.2767 (values outside
+        this range are clipped). This suits normalised difference
+        indices (e.g. 'NDVI'), but a larger value should be used for
+        unbounded indices such as 'BAI' or 'WI'.
         
     Returns
     -------
@@ -122,147 +608,27 @@ def calculate_indices(ds,
         original Dataset. 
     """
     
-    # Set ds equal to a copy of itself in order to prevent the function 
-    # from editing the input dataset. This can prevent unexpected
-    # behaviour though it uses twice as much memory.    
+    # Set ds equal to a shallow copy of itself in order to prevent the
+    # function from editing the input dataset. Bands are only ever added
+    # to or removed from the copy, so the underlying data can be shared
+    # with the input dataset rather than duplicated.
     if not inplace:
-        ds = ds.copy(deep=True)
+        ds = ds.copy(deep=False)
     
     # Capture input band names in order to drop these if drop=True
     if drop:
         bands_to_drop=list(ds.data_vars)
         print(f'Dropping bands {bands_to_drop}')
 
-    # Dictionary containing remote sensing index band recipes
-    index_dict = {
-                  # Normalised Difference Vegation Index, Rouse 1973
-                  'NDVI': lambda ds: (ds.nir - ds.red) /
-                                     (ds.nir + ds.red),
-
-                  # Enhanced Vegetation Index, Huete 2002
-                  'EVI': lambda ds: ((2.5 * (ds.nir - ds.red)) /
-                                     (ds.nir + 6 * ds.red -
-                                      7.5 * ds.blue + 1)),
-
-                  # Leaf Area Index, Boegh 2002
-                  'LAI': lambda ds: (3.618 * ((2.5 * (ds.nir - ds.red)) /
-                                     (ds.nir + 6 * ds.red -
-                                      7.5 * ds.blue + 1)) - 0.118),
-
-                  # Soil Adjusted Vegetation Index, Huete 1988
-                  'SAVI': lambda ds: ((1.5 * (ds.nir - ds.red)) /
-                                      (ds.nir + ds.red + 0.5)),
-      
-                  # Mod. Soil Adjusted Vegetation Index, Qi et al. 1994
-                  'MSAVI': lambda ds: ((2 * ds.nir + 1 - 
-                                      ((2 * ds.nir + 1)**2 - 
-                                       8 * (ds.nir - ds.red))**0.5) / 2),    
-
-                  # Normalised Difference Moisture Index, Gao 1996
-                  'NDMI': lambda ds: (ds.nir - ds.swir1) /
-                                     (ds.nir + ds.swir1),
-
-                  # Normalised Burn Ratio, Lopez Garcia 1991
-                  'NBR': lambda ds: (ds.nir - ds.swir2) /
-                                    (ds.nir + ds.swir2),
-
-                  # Burn Area Index, Martin 1998
-                  'BAI': lambda ds: (1.0 / ((0.10 - ds.red) ** 2 +
-                                            (0.06 - ds.nir) ** 2)),
-        
-                 # Normalised Difference Chlorophyll Index, 
-                 # (Mishra & Mishra, 2012)
-                  'NDCI': lambda ds: (ds.red_edge_1 - ds.red) /
-                                     (ds.red_edge_1 + ds.red),
-
-                  # Normalised Difference Snow Index, Hall 1995
-                  'NDSI': lambda ds: (ds.green - ds.swir1) /
-                                     (ds.green + ds.swir1),
-
-                  # Normalised Difference Tillage Index,
-                  # Van Deventer et al. 1997
-                  'NDTI': lambda ds: (ds.swir1 - ds.swir2) /
-                                     (ds.swir1 + ds.swir2),
-
-                  # Normalised Difference Water Index, McFeeters 1996
-                  'NDWI': lambda ds: (ds.green - ds.nir) /
-                                     (ds.green + ds.nir),
-
-                  # Modified Normalised Difference Water Index, Xu 2006
-                  'MNDWI': lambda ds: (ds.green - ds.swir1) /
-                                      (ds.green + ds.swir1),
-      
-                  # Normalised Difference Built-Up Index, Zha 2003
-                  'NDBI': lambda ds: (ds.swir1 - ds.nir) /
-                                     (ds.swir1 + ds.nir),
-      
-                  # Built-Up Index, He et al. 2010
-                  'BUI': lambda ds:  ((ds.swir1 - ds.nir) /
-                                      (ds.swir1 + ds.nir)) -
-                                     ((ds.nir - ds.red) /
-                                      (ds.nir + ds.red)),
-      
-                  # Built-up Area Extraction Index, Bouzekri et al. 2015
-                  'BAEI': lambda ds: (ds.red + 0.3) /
-                                     (ds.green + ds.swir1),
-      
-                  # New Built-up Index, Jieli et al. 2010
-                  'NBI': lambda ds: (ds.swir1 + ds.red) / ds.nir,
-      
-                  # Bare Soil Index, Rikimaru et al. 2002
-                  'BSI': lambda ds: ((ds.swir1 + ds.red) - 
-                                     (ds.nir + ds.blue)) / 
-                                    ((ds.swir1 + ds.red) + 
-                                     (ds.nir + ds.blue)),
-
-                  # Automated Water Extraction Index (no shadows), Feyisa 2014
-                  'AWEI_ns': lambda ds: (4 * (ds.green - ds.swir1) -
-                                        (0.25 * ds.nir * + 2.75 * ds.swir2)),
-
-                  # Automated Water Extraction Index (shadows), Feyisa 2014
-                  'AWEI_sh': lambda ds: (ds.blue + 2.5 * ds.green -
-                                         1.5 * (ds.nir + ds.swir1) -
-                                         0.25 * ds.swir2),
-
-                  # Water Index, Fisher 2016
-                  'WI': lambda ds: (1.7204 + 171 * ds.green + 3 * ds.red -
-                                    70 * ds.nir - 45 * ds.swir1 -
-                                    71 * ds.swir2),
-
-                  # Tasseled Cap Wetness, Crist 1985
-                  'TCW': lambda ds: (0.0315 * ds.blue + 0.2021 * ds.green +
-                                     0.3102 * ds.red + 0.1594 * ds.nir +
-                                    -0.6806 * ds.swir1 + -0.6109 * ds.swir2),
-
-                  # Tasseled Cap Greeness, Crist 1985
-                  'TCG': lambda ds: (-0.1603 * ds.blue + -0.2819 * ds.green +
-                                     -0.4934 * ds.red + 0.7940 * ds.nir +
-                                     -0.0002 * ds.swir1 + -0.1446 * ds.swir2),
-
-                  # Tasseled Cap Brightness, Crist 1985
-                  'TCB': lambda ds: (0.2043 * ds.blue + 0.4158 * ds.green +
-                                     0.5524 * ds.red + 0.5741 * ds.nir +
-                                     0.3124 * ds.swir1 + -0.2303 * ds.swir2),
-
-                  # Clay Minerals Ratio, Drury 1987
-                  'CMR': lambda ds: (ds.swir1 / ds.swir2),
-
-                  # Ferrous Minerals Ratio, Segal 1982
-                  'FMR': lambda ds: (ds.swir1 / ds.nir),
-
-                  # Iron Oxide Ratio, Segal 1982
-                  'IOR': lambda ds: (ds.red / ds.blue)
-    }
-    
     # If index supplied is not a list, convert to list. This allows us to
     # iterate through either multiple or single indices in the loop below
     indices = index if isinstance(index, list) else [index]
     
-    #calculate for each index in the list of indices supplied (indexes)
+    # Verify each index in the list of indices supplied (indexes)
     for index in indices:
 
         # Select an index function from the dictionary
-        index_func = index_dict.get(str(index))
+        index_func = _INDEX_DICT.get(str(index))
 
         # If no index is provided or if no function is returned due to an 
         # invalid option being provided, raise an exception informing user to 
@@ -290,93 +656,70 @@ def calculate_indices(ds,
                               "refer to the function documentation for a full "
                               "list of valid options for `index`")
 
-        # Rename bands to a consistent format if depending on what collection
-        # is specified in `collection`. This allows the same index calculations
-        # to be applied to all collections. If no collection was provided, 
-        # raise an exception.
-        if collection is None:
-
-            raise ValueError("'No `collection` was provided. Please specify "
-                             "either 'ga_ls_2', 'ga_ls_3' or 'ga_s2_1' \nto "
-                             "ensure the function calculates indices using the "
-                             "correct spectral bands")
-
-        elif collection == 'ga_ls_3':
-
-            # Dictionary mapping full data names to simpler 'red' alias names
-            bandnames_dict = {
-                'nbart_nir': 'nir',
-                'nbart_red': 'red',
-                'nbart_green': 'green',
-                'nbart_blue': 'blue',
-                'nbart_swir_1': 'swir1',
-                'nbart_swir_2': 'swir2',
-                'nbar_red': 'red',
-                'nbar_green': 'green',
-                'nbar_blue': 'blue',
-                'nbar_nir': 'nir',
-                'nbar_swir_1': 'swir1',
-                'nbar_swir_2': 'swir2'
-            }
-
-            # Rename bands in dataset to use simple names (e.g. 'red')
-            bands_to_rename = {
-                a: b for a, b in bandnames_dict.items() if a in ds.variables
-            }
-
-        elif collection == 'ga_s2_1':
-
-            # Dictionary mapping full data names to simpler 'red' alias names
-            bandnames_dict = {
-                'nbart_red': 'red',
-                'nbart_green': 'green',
-                'nbart_blue': 'blue',
-                'nbart_nir_1': 'nir',
-                'nbart_red_edge_1': 'red_edge_1', 
-                'nbart_red_edge_2': 'red_edge_2',    
-                'nbart_swir_2': 'swir1',
-                'nbart_swir_3': 'swir2',
-                'nbar_red': 'red',
-                'nbar_green': 'green',
-                'nbar_blue': 'blue',
-                'nbar_nir_1': 'nir',
-                'nbar_red_edge_1': 'red_edge_1',   
-                'nbar_red_edge_2': 'red_edge_2',   
-                'nbar_swir_2': 'swir1',
-                'nbar_swir_3': 'swir2'
-            }
-
-            # Rename bands in dataset to use simple names (e.g. 'red')
-            bands_to_rename = {
-                a: b for a, b in bandnames_dict.items() if a in ds.variables
-            }
-
-        elif collection == 'ga_ls_2':
-
-            # Pass an empty dict as no bands need renaming
-            bands_to_rename = {}
-
-        # Raise error if no valid collection name is provided:
-        else:
-            raise ValueError(f"'{collection}' is not a valid option for "
-                              "`collection`. Please specify either \n"
-                              "'ga_ls_2', 'ga_ls_3' or 'ga_s2_1'")
-
-        # Apply index function 
-        try:
-            # If normalised=True, divide data by 10,000 before applying func
-            mult = 10000.0 if normalise else 1.0
-            index_array = index_func(ds.rename(bands_to_rename) / mult)
-        except AttributeError:
-            raise ValueError(f'Please verify that all bands required to '
-                             f'compute {index} are present in `ds`. \n'
-                             f'These bands may vary depending on the `collection` '
-                             f'(e.g. the Landsat `nbart_nir` band \n'
-                             f'is equivelent to `nbart_nir_1` for Sentinel 2)')
-
-        # Add as a new variable in dataset
+    # Rename bands to a consistent format if depending on what collection
+    # is specified in `collection`. This allows the same index calculations
+    # to be applied to all collections. If no collection was provided, 
+    # raise an exception.
+    if collection is None:
+
+        raise ValueError("'No `collection` was provided. Please specify "
+                         "either 'ga_ls_2', 'ga_ls_3' or 'ga_s2_1' \nto "
+                         "ensure the function calculates indices using the "
+                         "correct spectral bands")
+
+    # Raise error if no valid collection name is provided:
+    elif collection not in _BANDNAMES_DICT:
+        raise ValueError(f"'{collection}' is not a valid option for "
+                          "`collection`. Please specify either \n"
+                          "'ga_ls_2', 'ga_ls_3' or 'ga_s2_1'")
+
+    # Rename bands in dataset to use simple names (e.g. 'red')
+    bands_to_rename = {
+        a: b for a, b in _BANDNAMES_DICT[collection].items()
+        if a in ds.variables
+    }
+
+    # Select only the bands required by the selected indices, as a
+    # renamed view of the input dataset that does not copy any data
+    renamed_ds = ds.rename(bands_to_rename)
+    _, required_bands = _trace_indices(indices)
+    if any(band not in renamed_ds.data_vars for band in required_bands):
+        raise ValueError(f'Please verify that all bands required to '
+                         f'compute {", ".join(indices)} are present in `ds`. \n'
+                         f'These bands may vary depending on the `collection` '
+                         f'(e.g. the Landsat `nbart_nir` band \n'
+                         f'is equivelent to `nbart_nir_1` for Sentinel 2)')
+    bands_ds = renamed_ds[required_bands]
+
+    # Apply index functions, either all at once using a fused kernel or
+    # one at a time using xarray. If normalised=True, divide data by
+    # 10,000 before applying func
+    mult = 10000.0 if normalise else 1.0
+    if fused:
+        index_arrays = _calculate_indices_fused(bands_ds, indices, mult,
+                                                dtype, scale_factor)
+    else:
+        # Mask and normalise each required band only once
+        bands_ds = _mask_nodata(bands_ds) / mult
+        index_arrays = {index: _INDEX_DICT[index](bands_ds)
+                        for index in indices}
+
+        # Optionally encode indices as a reduced precision dtype
+        if dtype is not None:
+            index_arrays = {
+                index: xr.apply_ufunc(_encode_block,
+                                      index_array,
+                                      kwargs={'dtype': dtype,
+                                              'scale_factor': scale_factor},
+                                      dask='parallelized',
+                                      output_dtypes=[np.dtype(dtype)])
+                .assign_attrs(_encoding_attrs(dtype, scale_factor))
+                for index, index_array in index_arrays.items()}
+
+    # Add as new variables in dataset
+    for index in indices:
         output_band_name = custom_varname if custom_varname else index
-        ds[output_band_name] = index_array
+        ds[output_band_name] = index_arrays[index]
     
     # Once all indexes are calculated, drop input bands if inplace=False
     if drop and not inplace:
@@ -389,3 +732,57 @@ def calculate_indices(ds,
 
     # Return input dataset with added water index variable
     return ds
+
+
+def index_bands(index, collection, prefix='nbart'):
+    """
+    Returns the names of the measurements required to calculate one or
+    more remote sensing indices using `calculate_indices`, for example
+    to load only these bands using `dc.load` or `load_ard`.
+
+    Parameters
+    ----------
+    index : str or list of strs
+        A string giving the name of the index to calculate or a list of
+        strings giving the names of the indices to calculate (see
+        `calculate_indices` for a full list of valid options).
+    collection : str
+        A string giving the data collection being used: 'ga_ls_2',
+        'ga_ls_3' or 'ga_s2_1' (see `calculate_indices`).
+    prefix : str, optional
+        The type of surface reflectance bands to return for 'ga_ls_3'
+        and 'ga_s2_1', either 'nbart' (the default) or 'nbar'.
+
+    Returns
+    -------
+    bands : list of strs
+        The names of the measurements required to calculate all of the
+        indices, e.g. `['nbart_nir', 'nbart_red']` for 'NDVI' and
+        'ga_ls_3'.
+    """
+
+    indices = index if isinstance(index, list) else [index]
+
+    invalid = [index for index in indices if index not in _INDEX_DICT]
+    if invalid:
+        raise ValueError(f"The selected index '{invalid[0]}' is not one of "
+                          "the valid remote sensing index options. \nPlease "
+                          "refer to the `calculate_indices` documentation "
+                          "for a full list of valid options for `index`")
+
+    if collection not in _BANDNAMES_DICT:
+        raise ValueError(f"'{collection}' is not a valid option for "
+                          "`collection`. Please specify either \n"
+                          "'ga_ls_2', 'ga_ls_3' or 'ga_s2_1'")
+
+    # GA Landsat Collection 2 bands already use simple names
+    _, bands = _trace_indices(indices)
+    if not _BANDNAMES_DICT[collection]:
+        return bands
+
+    # Otherwise, map simple names back to measurement names
+    measurement_names = {
+        b: a for a, b in _BANDNAMES_DICT[collection].items()
+        if a.startswith(f'{prefix}_')
+    }
+    return [measurement_names[band] for band in bands]
@@ -19,14 +19,19 @@ Github (https://github.com/GeoscienceAustralia/dea-notebooks/issues/new).
 
 Functions included:
     load_ard
+    load_ard_iter
+    load_ard_cached
+    dataset_cache_info
+    clear_dataset_cache
     array_to_geotiff
+    xr_to_geotiff
     mostcommon_utm
     download_unzip
     wofs_fuser
+    bitflag_fuser
     dilate
     pan_sharpen_brovey
     paths_to_datetimeindex
-    _select_along_axis
     nearest
     last
     first
@@ -38,23 +43,145 @@ Last modified: July 2020
 # Import required packages
 import os
 import gdal
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import zlib
 import zipfile
-import numexpr
 import datetime
 import requests
 import warnings
+import threading
 import odc.algo
 import dask
+import rasterio
 import numpy as np
 import pandas as pd
-import numexpr as ne
 import dask.array as da
 import xarray as xr
 from random import randint
-from collections import Counter
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datacube.utils import masking
-from scipy.ndimage import binary_dilation
+from datacube.api.query import Query, solar_day
+from datacube.api.core import output_geobox
+from datacube.storage import measurement_paths
+from scipy.ndimage import distance_transform_edt
 from datacube.utils.dates import normalise_dt
+from datacube.utils.geometry import CRS, assign_crs
+
+# Load utility functions
+from dea_bandindices import calculate_indices, index_bands
+
+
+# In-process cache of dataset searches and product definitions, used
+# to avoid repeated database queries when `load_ard` is called multiple
+# times for the same products, area and time. Cached entries expire
+# after `_DATASET_CACHE_TTL` seconds, and the least recently used
+# entries are dropped once `_DATASET_CACHE_SIZE` entries are stored
+_DATASET_CACHE = OrderedDict()
+_DATASET_CACHE_SIZE = 256
+_DATASET_CACHE_TTL = 600
+_DATASET_CACHE_STATS = Counter(hits=0, misses=0)
+_DATASET_CACHE_LOCK = threading.Lock()
+
+
+def _normalise_query(value):
+    """
+    Converts query parameters into a hashable representation that can
+    be used as part of a cache key (e.g. lists and tuples compare as
+    equal, and dictionary keys are sorted).
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), _normalise_query(v))
+                            for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalise_query(v) for v in value)
+    return str(value)
+
+
+def _cached(key, func):
+    """
+    Returns the result of `func()` from the in-process dataset cache if
+    a non-expired result for `key` exists, otherwise calls `func` and
+    adds its result to the cache.
+    """
+    with _DATASET_CACHE_LOCK:
+        if key in _DATASET_CACHE:
+            timestamp, result = _DATASET_CACHE[key]
+            if time.monotonic() - timestamp < _DATASET_CACHE_TTL:
+                _DATASET_CACHE.move_to_end(key)
+                _DATASET_CACHE_STATS['hits'] += 1
+                return result
+            del _DATASET_CACHE[key]
+        _DATASET_CACHE_STATS['misses'] += 1
+
+    # Run function outside the lock so that searches can run in parallel
+    result = func()
+
+    with _DATASET_CACHE_LOCK:
+        _DATASET_CACHE[key] = (time.monotonic(), result)
+        _DATASET_CACHE.move_to_end(key)
+        while len(_DATASET_CACHE) > _DATASET_CACHE_SIZE:
+            _DATASET_CACHE.popitem(last=False)
+
+    return result
+
+
+def _index_id(dc):
+    """
+    Returns a string identifying the database index of a Datacube,
+    so that results from different databases are cached separately.
+    """
+    return str(getattr(dc.index, 'url', id(dc.index)))
+
+
+def _find_datasets_cached(dc, product, **query):
+    """
+    Cached version of `dc.find_datasets` for a single product.
+    """
+    key = ('datasets', _index_id(dc), product, _normalise_query(query))
+    return _cached(key, lambda: dc.find_datasets(product=product, **query))
+
+
+def _get_product_cached(dc, product):
+    """
+    Cached version of `dc.index.products.get_by_name`.
+    """
+    key = ('product', _index_id(dc), product)
+    return _cached(key, lambda: dc.index.products.get_by_name(product))
+
+
+def dataset_cache_info():
+    """
+    Returns statistics for the in-process cache used by `load_ard` to
+    avoid repeating dataset searches and product lookups.
+
+    Returns
+    -------
+    A dictionary giving the number of cache `hits` and `misses`, and
+    the current number of cached entries (`size`).
+    """
+    with _DATASET_CACHE_LOCK:
+        return {'hits': _DATASET_CACHE_STATS['hits'],
+                'misses': _DATASET_CACHE_STATS['misses'],
+                'size': len(_DATASET_CACHE)}
+
+
+def clear_dataset_cache():
+    """
+    Removes all entries from the in-process cache used by `load_ard`
+    for dataset searches and product lookups, and resets the cache
+    statistics. This can be useful to pick up newly indexed data
+    before cached entries expire.
+    """
+    with _DATASET_CACHE_LOCK:
+        _DATASET_CACHE.clear()
+        _DATASET_CACHE_STATS['hits'] = 0
+        _DATASET_CACHE_STATS['misses'] = 0
 
 
 def _dc_query_only(**kw):
@@ -96,7 +223,7 @@ def _common_bands(dc, products):
     bands = None
 
     for p in products:
-        p = dc.index.products.get_by_name(p)
+        p = _get_product_cached(dc, p)
         if common is None:
             common = set(p.measurements)
             bands = list(p.measurements)
@@ -105,6 +232,270 @@ def _common_bands(dc, products):
     return [band for band in bands if band in common]
 
 
+def _gooddata_fraction(dc,
+                       dataset_list,
+                       fmask_band,
+                       fmask_categories,
+                       gooddata_resolution=None,
+                       **kwargs):
+    """
+    Calculates the proportion of good quality pixels in each timestep
+    by loading only the `fmask` band in large spatial chunks (and
+    optionally at a coarser resolution). This allows the good data
+    proportion to be computed as a small, separate dask graph, without
+    computing any of the other bands being loaded.
+
+    Returns
+    -------
+    An xarray.DataArray with the proportion of good quality pixels
+    for each timestep.
+    """
+
+    # Load fmask with one chunk per timestep (spatial dimensions are
+    # not chunked), resampling using nearest neighbour as fmask is a
+    # categorical band
+    load_kwargs = dict(kwargs, resampling='nearest')
+    if gooddata_resolution is not None:
+        load_kwargs['resolution'] = gooddata_resolution
+        load_kwargs.pop('align', None)
+    fmask = dc.load(datasets=dataset_list,
+                    measurements=[fmask_band],
+                    dask_chunks={'time': 1},
+                    **load_kwargs)[fmask_band]
+
+    # Compute proportion of good pixels for each timestep, persisting
+    # only the resulting 1D vector
+    pq_mask = odc.algo.fmask_to_bool(fmask, categories=fmask_categories)
+    data_perc = (pq_mask.sum(axis=[1, 2], dtype='int32') /
+                 (pq_mask.shape[1] * pq_mask.shape[2]))
+
+    return data_perc.compute()
+
+
+def _metadata_gooddata(dataset_list, group_by=None, **query):
+    """
+    Estimates the proportion of good quality pixels in each timestep
+    that would be loaded from a list of datasets, using only indexed
+    metadata (i.e. without reading any pixel data). For each dataset,
+    the area of its footprint that overlaps the query polygon is
+    multiplied by the proportion of the dataset that is not cloudy
+    (based on its `cloud_cover` metadata, if available). These are
+    then summed across all datasets that will be grouped into the same
+    timestep, and divided by the area of the query polygon.
+
+    Returns
+    -------
+    A dictionary mapping dataset IDs to the estimated proportion of
+    good quality pixels in the timestep each dataset contributes to.
+    """
+
+    # Obtain query polygon; if no spatial query was provided, assume
+    # each dataset completely covers the area being loaded
+    geopolygon = Query(**query).geopolygon
+
+    # Group datasets in the same way `dc.load` will group them into
+    # timesteps
+    groups = defaultdict(list)
+    for ds in dataset_list:
+        key = solar_day(ds) if group_by == 'solar_day' else ds.center_time
+        groups[key].append(ds)
+
+    estimates = {}
+    for group in groups.values():
+
+        good_area = 0.0
+        for ds in group:
+
+            # Proportion of query polygon covered by dataset footprint,
+            # calculated in the dataset's (projected) CRS
+            if geopolygon is None or ds.extent is None:
+                overlap = 1.0
+            else:
+                query_poly = geopolygon.to_crs(ds.extent.crs)
+                overlap = (ds.extent.intersection(query_poly).area /
+                           query_poly.area)
+
+            # Proportion of dataset not affected by cloud
+            cloud_cover = getattr(ds.metadata, 'cloud_cover', None)
+            clear = 1.0 if cloud_cover is None else 1 - cloud_cover / 100
+
+            good_area += overlap * clear
+
+        for ds in group:
+            estimates[ds.id] = min(good_area, 1.0)
+
+    return estimates
+
+
+def _worker_memory():
+    """
+    Returns the memory limit (in bytes) and number of threads of the
+    smallest worker in the active dask distributed cluster (e.g. as
+    created by `dea_dask.create_local_dask_cluster`), or None if no
+    cluster is running.
+    """
+    try:
+        from distributed import get_client
+        workers = get_client().scheduler_info()['workers'].values()
+        memory_limit = min(w['memory_limit'] for w in workers)
+        nthreads = max(w['nthreads'] for w in workers)
+        return memory_limit, nthreads
+    except (ImportError, ValueError):
+        return None
+
+
+def _auto_dask_chunks(dc, dataset_list, measurements, **kwargs):
+    """
+    Chooses `dask_chunks` for a `dc.load` call based on the size of the
+    area being loaded, the number of bands and their data type, the
+    internal tiling of the source files, and the memory available to
+    each dask worker.
+
+    Spatial chunks are sized so that the chunks for all bands being
+    processed at once by each worker thread fit comfortably within
+    the worker's memory, and rounded down to a multiple of the native
+    block size of the source data when loading in the native CRS. If the entire spatial extent fits within a
+    single chunk, multiple timesteps are combined into each chunk to
+    reduce the number of tasks.
+
+    Returns
+    -------
+    A dictionary of chunk sizes that can be passed to `dc.load`.
+    """
+
+    product = dataset_list[0].type
+
+    # Compute the output pixel grid in the same way as `dc.load`
+    load_query = _dc_query_only(**kwargs)
+    load_query.pop('like', None)
+    geobox = output_geobox(output_crs=kwargs.get('output_crs'),
+                           resolution=kwargs.get('resolution'),
+                           align=kwargs.get('align'),
+                           like=kwargs.get('like'),
+                           grid_spec=product.grid_spec,
+                           load_hints=product.load_hints(),
+                           datasets=dataset_list,
+                           **load_query)
+    y_dim, x_dim = geobox.dimensions
+    ny, nx = geobox.shape
+
+    # Data are typically converted to float32 after loading, so size
+    # chunks for at least 4 bytes per pixel
+    dtypes = [m.dtype for m in product.lookup_measurements(
+        measurements).values()]
+    pixel_bytes = max([np.dtype(i).itemsize for i in dtypes] + [4])
+
+    # Use the internal block size of the source files (converted to the
+    # output resolution) so that chunks do not split blocks. This is
+    # only possible if the data is loaded in its native CRS; otherwise
+    # chunks are sized using the memory target alone
+    block = None
+    try:
+        band = next(iter(measurement_paths(dataset_list[0]).values()))
+        with rasterio.open(band) as src:
+            native_block = src.block_shapes[0][0]
+            native_res = abs(src.res[0])
+            native_crs = CRS(src.crs.to_wkt())
+        if native_crs == geobox.crs:
+            block = max(1, int(native_block * native_res /
+                               abs(geobox.resolution[0])))
+    except (StopIteration, KeyError, ValueError,
+            rasterio.errors.RasterioError) as e:
+        warnings.warn(f'Unable to read the native block size of the '
+                      f'source data ({e}); chunks will not be aligned '
+                      f'to storage blocks')
+
+    # Target chunk size in bytes. If a dask cluster with a memory limit
+    # is running, leave room for each worker thread to hold a chunk for
+    # every band, plus temporary copies made during masking and dtype
+    # conversion. This per-worker budget is never exceeded, even on
+    # small workers; otherwise, use dask's default chunk size with a
+    # minimum of 16 MiB
+    worker_memory = _worker_memory()
+    if worker_memory is not None and worker_memory[0]:
+        memory_limit, nthreads = worker_memory
+        target_bytes = min(
+            memory_limit / (nthreads * len(measurements) * 4), 2 ** 28)
+    else:
+        target_bytes = np.clip(dask.utils.parse_bytes(
+            dask.config.get('array.chunk-size')), 2 ** 24, 2 ** 28)
+    target_pixels = int(target_bytes // pixel_bytes)
+
+    # Square spatial chunks within the memory target, rounded down to a
+    # multiple of the block size where possible, and limited to the
+    # size of the spatial extent
+    side = max(1, int(np.sqrt(target_pixels)))
+    if block is not None and block <= side:
+        side = side // block * block
+    y_chunk = min(ny, side)
+    x_chunk = min(nx, side)
+
+    # Combine timesteps if the spatial extent fits in a single chunk
+    time_chunk = max(1, min(len(dataset_list),
+                            target_pixels // (y_chunk * x_chunk)))
+
+    return {'time': int(time_chunk), y_dim: int(y_chunk), x_dim: int(x_chunk)}
+
+
+def _drop_superseded_nrt(dataset_list):
+    """
+    Removes Near Real Time (NRT) datasets that have been superseded by
+    a Definitive dataset for the same acquisition (i.e. from the same
+    platform, acquired within a minute, with overlapping footprints).
+
+    Returns
+    -------
+    The list of datasets with superseded NRT datasets removed.
+    """
+
+    # Index Definitive datasets by platform and acquisition date
+    definitive = defaultdict(list)
+    for ds in dataset_list:
+        if 'nrt' not in ds.type.name:
+            key = (getattr(ds.metadata, 'platform', None),
+                   ds.center_time.date())
+            definitive[key].append(ds)
+
+    def _is_superseded(ds):
+        key = (getattr(ds.metadata, 'platform', None),
+               ds.center_time.date())
+        return any(
+            abs(ds.center_time - i.center_time) < datetime.timedelta(minutes=1)
+            and (ds.extent is None or i.extent is None or
+                 ds.extent.to_crs(i.extent.crs).intersects(i.extent))
+            for i in definitive[key])
+
+    return [ds for ds in dataset_list if
+            'nrt' not in ds.type.name or not _is_superseded(ds)]
+
+
+def _first_nrt_timestep(dc, products, times, **kwargs):
+    """
+    Returns the earliest of `times` (e.g. the timesteps of a dataset
+    previously returned by `load_ard`) that may have been loaded from a
+    Near Real Time (NRT) dataset, or None if no NRT products are being
+    loaded or no timesteps match an NRT acquisition.
+    """
+    nrt_products = [product for product in products if 'nrt' in product]
+    if not nrt_products or len(times) == 0:
+        return None
+
+    # Search for NRT datasets over the period covered by `times`
+    times = pd.DatetimeIndex(times)
+    tolerance = pd.Timedelta(12, 'h')
+    query = _dc_query_only(**kwargs)
+    query['time'] = ((times.min() - tolerance).isoformat(),
+                     (times.max() + tolerance).isoformat())
+    nrt_times = [pd.Timestamp(normalise_dt(ds.center_time))
+                 for product in nrt_products
+                 for ds in _find_datasets_cached(dc, product, **query)]
+
+    # Timesteps grouped from an NRT acquisition (i.e. by solar day)
+    matches = [time for time in times
+               if any(abs(time - i) < tolerance for i in nrt_times)]
+    return min(matches) if matches else None
+
+
 def load_ard(dc,
              products=None,
              min_gooddata=0.0,
@@ -114,6 +505,12 @@ def load_ard(dc,
              ls7_slc_off=True,
              predicate=None,
              dtype='auto',
+             gooddata_resolution=None,
+             prefilter_metadata=False,
+             valid_band=None,
+             indices=None,
+             index_prefix=None,
+             append_to=None,
              **kwargs):
 
     """
@@ -134,6 +531,12 @@ def load_ard(dc,
         s2a_nrt_granule
         s2b_nrt_granule
 
+    Dataset searches for each product are run in parallel, and their
+    results are cached in-process for a short time so that repeated
+    calls for the same products, area and time period do not need to
+    query the database again (see `dataset_cache_info` and
+    `clear_dataset_cache`).
+
     Last modified: June 2020
 
     Parameters
@@ -187,7 +590,10 @@ def load_ard(dc,
         be returned in the native data type of the data. Be aware that
         if data is loaded in its native dtype, nodata and masked
         pixels will be returned with the data's native nodata value
-        (typically -999), not NaN.
+        (typically -999), not NaN. Using 'native' alongside masking can
+        halve memory use compared to 'float32'; functions such as
+        `calculate_indices` and `xr_phenology` will automatically treat
+        these native nodata values as NaN.
     ls7_slc_off : bool, optional
         An optional boolean indicating whether to include data from
         after the Landsat 7 SLC failure (i.e. SLC-off). Defaults to
@@ -200,6 +606,71 @@ def load_ard(dc,
         For example, a predicate function could be used to return True
         for only datasets acquired in January:
         `dataset.time.begin.month == 1`
+    gooddata_resolution : tuple, optional
+        An optional resolution (e.g. `(-300, 300)`) at which to load
+        `fmask` when calculating the `min_gooddata` proportion of good
+        quality pixels. When `dask_chunks` are supplied, the good data
+        proportion is calculated from a separate, fmask-only load that
+        is computed ahead of the rest of the data, leaving all other
+        bands as lazy dask arrays. Loading fmask at a coarser resolution
+        (using nearest neighbour resampling) can greatly reduce the time
+        taken to calculate this proportion, at the cost of a small loss
+        of precision. Defaults to None, which uses the resolution of
+        the main load.
+    prefilter_metadata : bool, optional
+        An optional boolean indicating whether to drop datasets using
+        indexed metadata before any pixel data is loaded. If True and
+        `min_gooddata` is greater than 0.0, the proportion of good
+        quality pixels in each timestep is first estimated from the
+        `cloud_cover` metadata of each dataset and how much of the query
+        area the dataset footprints cover, and datasets that are
+        unlikely to meet `min_gooddata` are dropped. Remaining datasets
+        are then filtered using `fmask` as normal. Because `cloud_cover`
+        is calculated across each entire scene, this is an approximation
+        that may occasionally drop observations that are clear over the
+        query area. Defaults to False. Note that metadata search fields
+        can also be used to filter datasets directly by passing them as
+        query parameters (e.g. `cloud_cover=(0, 50)` or
+        `gqa_iterative_mean_xy=(0, 1)`).
+    valid_band : str, optional
+        An optional name for an extra boolean band to add to the output
+        dataset that records which pixels passed pixel quality and/or
+        contiguity masking (True for valid pixels). This compact layer
+        (one byte per pixel, shared by all bands) is useful alongside
+        `dtype='native'`, as it allows masked pixels to be identified
+        without converting data to float. Defaults to None, which will
+        not add a validity band.
+    indices : str or list of strs, optional
+        An optional remote sensing index name (e.g. 'NDVI') or list of
+        index names (e.g. `['NDVI', 'MNDWI']`) to calculate at load time
+        (see `dea_bandindices.calculate_indices` for valid options).
+        Only the surface reflectance bands required to calculate these
+        indices are loaded, indices are calculated block-by-block as
+        data is loaded, and the input bands are not returned. Any
+        `measurements` provided are returned alongside the indices.
+        If no other `measurements` are
+        requested and `dtype='auto'`, bands are loaded in their native
+        dtype to minimise memory use. Defaults to None, which returns
+        the loaded bands without calculating any indices.
+    index_prefix : str, optional
+        The type of surface reflectance bands used to calculate
+        `indices`, either 'nbart' or 'nbar'. Defaults to None, which
+        uses 'nbar' if any 'nbar_' bands are included in `measurements`,
+        and 'nbart' otherwise.
+    append_to : xarray Dataset, optional
+        An optional dataset previously returned by `load_ard` (or
+        `load_ard_cached`) to update with new observations. If provided,
+        only observations acquired after the last timestep in
+        `append_to` (up to the end of any `time` query, or the present)
+        are found, loaded and masked, then appended to `append_to`. The
+        same products, measurements and options used to load
+        `append_to` should be provided. This can be much faster than
+        re-loading an entire time series to pick up new acquisitions,
+        for example for near real time monitoring. If Near Real Time
+        products are loaded, any timesteps in `append_to` from the first
+        Near Real Time observation onwards are also re-loaded, so that
+        Near Real Time data replaced by Definitive data is updated. If
+        no new data is available, `append_to` is returned unchanged.
     **kwargs :
         A set of keyword arguments to `dc.load` that define the
         spatiotemporal query and load parameters used to extract data.
@@ -210,6 +681,12 @@ def load_ard(dc,
         `x`, `y`, `time`, `resolution`, `resampling`, `group_by`, `crs`;
         see the `dc.load` documentation for all possible options:
         https://datacube-core.readthedocs.io/en/latest/dev/api/generate/datacube.Datacube.load.html
+        To return data lazily as dask arrays, pass `dask_chunks`
+        (e.g. `dask_chunks={'time': 1, 'x': 2048, 'y': 2048}`), or set
+        `dask_chunks='auto'` to automatically choose chunk sizes based
+        on the area being loaded, the bands requested, the tiling of
+        the source files and the memory available to any running dask
+        cluster.
 
     Returns
     -------
@@ -224,6 +701,68 @@ def load_ard(dc,
     # Setup #
     #########
 
+    # If an existing dataset is provided, load only observations newer
+    # than its final timestep and append these to the existing data
+    if append_to is not None:
+
+        time = kwargs.pop('time', None)
+        end = time[-1] if isinstance(time, (list, tuple)) else time
+
+        # When grouping by solar day, timesteps are labelled with the
+        # solar date rather than the acquisition time of the datasets
+        # they contain, so allow 12 hours either side of each timestep
+        tolerance = (pd.Timedelta(12, 'h')
+                     if kwargs.get('group_by') == 'solar_day'
+                     else pd.Timedelta(1, 'us'))
+        start = pd.Timestamp(append_to.time.values.max()) + tolerance
+
+        # Near Real Time (NRT) observations in `append_to` may since
+        # have been replaced by Definitive data, so re-load everything
+        # from the first NRT timestep onwards and replace these
+        nrt_start = _first_nrt_timestep(dc, products,
+                                        append_to.time.values, **kwargs)
+        if nrt_start is not None:
+            start = nrt_start - max(tolerance, pd.Timedelta(1, 'min'))
+            replaced = int((append_to.time >= start).sum())
+            append_to = append_to.sel(time=append_to.time < start)
+            print(f'Re-loading {replaced} time steps that may contain '
+                  f'Near Real Time data')
+        print(f'Finding observations after {start}')
+
+        try:
+            new_ds = load_ard(dc=dc,
+                              products=products,
+                              min_gooddata=min_gooddata,
+                              fmask_categories=fmask_categories,
+                              mask_pixel_quality=mask_pixel_quality,
+                              mask_contiguity=mask_contiguity,
+                              ls7_slc_off=ls7_slc_off,
+                              predicate=predicate,
+                              dtype=dtype,
+                              gooddata_resolution=gooddata_resolution,
+                              prefilter_metadata=prefilter_metadata,
+                              valid_band=valid_band,
+                              indices=indices,
+                              index_prefix=index_prefix,
+                              time=(start.isoformat(),
+                                    end or datetime.datetime.utcnow()
+                                    .isoformat()),
+                              **kwargs)
+        except ValueError as e:
+            if 'No data available' not in str(e):
+                raise
+            print('No new observations available')
+            return append_to
+
+        # Drop any timesteps that are already in `append_to`
+        new_ds = new_ds.sel(time=~new_ds.time.isin(append_to.time))
+        if len(new_ds.time) == 0:
+            print('No new observations available')
+            return append_to
+
+        print(f'Appending {len(new_ds.time)} new time steps')
+        return xr.concat([append_to, new_ds], dim='time')
+
     # Use 'nbart_contiguity' by default if mask_contiguity is true
     if mask_contiguity is True:
         mask_contiguity = 'nbart_contiguity'
@@ -232,14 +771,6 @@ def load_ard(dc,
     dask_chunks = kwargs.pop('dask_chunks', None)
     requested_measurements = kwargs.pop('measurements', None)
 
-    # Warn user if they combine lazy load with min_gooddata
-    if (min_gooddata > 0.0) and dask_chunks is not None:
-        warnings.warn("Setting 'min_gooddata' percentage to > 0.0 "
-                      "will cause dask arrays to compute when "
-                      "loading pixel-quality data to calculate "
-                      "'good pixel' percentage. This can "
-                      "slow the return of your dataset.")
-
     # Verify that products were provided, and determine if Sentinel-2
     # or Landsat data is being loaded
     if not products:
@@ -259,6 +790,27 @@ def load_ard(dc,
     measurements = (requested_measurements.copy() if
                     requested_measurements else None)
 
+    # If indices are requested, load only the bands required to
+    # calculate them (plus any other requested measurements)
+    if indices is not None:
+        indices = indices if isinstance(indices, list) else [indices]
+        collection = 'ga_ls_3' if product_type == 'ls' else 'ga_s2_1'
+        if index_prefix is None:
+            index_prefix = ('nbar' if any(band.startswith('nbar_') for
+                                          band in measurements or [])
+                            else 'nbart')
+        elif index_prefix not in ('nbart', 'nbar'):
+            raise ValueError("index_prefix should be either 'nbart' or "
+                             "'nbar'")
+        measurements = list(dict.fromkeys(
+            (measurements or []) + index_bands(indices, collection,
+                                               index_prefix)))
+
+        # Load in native dtype, as calculate_indices treats native
+        # nodata values as NaN
+        if dtype == 'auto' and not requested_measurements:
+            dtype = 'native'
+
     if measurements is None:
 
         # Deal with "load all" case: pick a set of bands common across
@@ -297,15 +849,21 @@ def load_ard(dc,
     # Extract datasets for each product using subset of dcload_kwargs
     dataset_list = []
 
-    # Get list of datasets for each product
+    # Search for datasets for each product in parallel (or return
+    # results from the cache if this query was recently run)
     print('Finding datasets')
-    for product in products:
+    with ThreadPoolExecutor(max_workers=len(products)) as executor:
+        product_datasets = list(executor.map(
+            lambda product: _find_datasets_cached(dc, product, **query),
+            products))
+
+    # Get list of datasets for each product
+    for product, datasets in zip(products, product_datasets):
 
         # Obtain list of datasets for product
         print(f'    {product} (ignoring SLC-off observations)'
               if not ls7_slc_off and product == 'ga_ls7e_ard_3'
               else f'    {product}')
-        datasets = dc.find_datasets(product=product, **query)
 
         # Remove Landsat 7 SLC-off observations if ls7_slc_off=False
         if not ls7_slc_off and product == 'ga_ls7e_ard_3':
@@ -322,6 +880,15 @@ def load_ard(dc,
                          "the products specified have data for the "
                          "time and location requested")
 
+    # If loading both Near Real Time and Definitive data, drop any NRT
+    # datasets that have since been replaced by Definitive datasets
+    if any('nrt' in product for product in products):
+        total_datasets = len(dataset_list)
+        dataset_list = _drop_superseded_nrt(dataset_list)
+        if len(dataset_list) < total_datasets:
+            print(f'Dropping {total_datasets - len(dataset_list)} NRT '
+                  f'datasets superseded by Definitive datasets')
+
     # If predicate is specified, use this function to filter the list
     # of datasets prior to load
     if predicate:
@@ -333,10 +900,33 @@ def load_ard(dc,
         raise ValueError("No data available after filtering with "
                          "predicate function")
 
+    # If requested, use indexed metadata to drop datasets that are
+    # unlikely to contain enough good quality pixels prior to load
+    if prefilter_metadata and min_gooddata > 0.0:
+        estimates = _metadata_gooddata(dataset_list,
+                                       group_by=kwargs.get('group_by'),
+                                       **query)
+        total_datasets = len(dataset_list)
+        dataset_list = [ds for ds in dataset_list if
+                        estimates[ds.id] >= min_gooddata]
+        print(f'Filtering to {len(dataset_list)} out of {total_datasets} '
+              f'datasets using metadata')
+
+        # Raise exception if filtering removes all datasets
+        if len(dataset_list) == 0:
+            raise ValueError("No data available after filtering using "
+                             "metadata; consider lowering `min_gooddata`")
+
     #############
     # Load data #
     #############
 
+    # Optionally choose chunk sizes automatically
+    if dask_chunks == 'auto':
+        dask_chunks = _auto_dask_chunks(dc, dataset_list, measurements,
+                                        **kwargs)
+        print(f'Using dask chunks {dask_chunks}')
+
     # Note we always load using dask here so that we can lazy load data
     # before filtering by good data
     ds = dc.load(datasets=dataset_list,
@@ -358,10 +948,21 @@ def load_ard(dc,
     # completely to save processing time
     if min_gooddata > 0.0:
 
-        # Compute good data for each observation as % of total pixels
+        # Compute good data for each observation as % of total pixels.
+        # If data is being lazily loaded, this is calculated using a
+        # separate fmask-only load so that only this small 1D vector is
+        # computed, and all other bands can be returned as dask arrays
         print('Counting good quality pixels for each time step')
-        data_perc = (pq_mask.sum(axis=[1, 2], dtype='int32') /
-                     (pq_mask.shape[1] * pq_mask.shape[2]))
+        if dask_chunks is not None or gooddata_resolution is not None:
+            data_perc = _gooddata_fraction(dc,
+                                           dataset_list,
+                                           fmask_band,
+                                           fmask_categories,
+                                           gooddata_resolution,
+                                           **kwargs)
+        else:
+            data_perc = (pq_mask.sum(axis=[1, 2], dtype='int32') /
+                         (pq_mask.shape[1] * pq_mask.shape[2]))
         keep = data_perc >= min_gooddata
 
         # Filter by `min_gooddata` to drop low quality observations
@@ -414,6 +1015,14 @@ def load_ard(dc,
     if dtype != 'native':
         ds_data = odc.algo.to_float(ds_data, dtype=dtype)
 
+    # Optionally record the combined mask as a compact boolean band
+    if valid_band is not None:
+        ds_masks[valid_band] = (xr.ones_like(ds[fmask_band], dtype=bool)
+                                if mask is None else mask.astype(bool))
+
+        # Don't inherit fmask's nodata or flag definitions
+        ds_masks[valid_band].attrs = {}
+
     # Put data and mask bands back together
     attrs = ds.attrs
     ds = xr.merge([ds_data, ds_masks])
@@ -423,9 +1032,20 @@ def load_ard(dc,
     # Return data #
     ###############
 
+    # Calculate indices using a fused kernel that is applied to each
+    # chunk of data as it is loaded
+    if indices is not None:
+        print(f'Calculating {", ".join(indices)}')
+        ds = calculate_indices(ds,
+                               index=indices,
+                               collection=collection,
+                               inplace=True,
+                               fused=True)
+
     # Drop bands not originally requested by user
-    if requested_measurements:
-        ds = ds[requested_measurements]
+    if requested_measurements or indices is not None:
+        ds = ds[(requested_measurements or []) + (indices or []) +
+                ([valid_band] if valid_band is not None else [])]
 
     # If user supplied dask_chunks, return data as a dask array without
     # actually loading it in
@@ -437,6 +1057,401 @@ def load_ard(dc,
         return ds.compute()
 
 
+def load_ard_iter(dc,
+                  time_block=1,
+                  prefetch=2,
+                  **kwargs):
+    """
+    Loads data using `load_ard`, but rather than returning a single
+    dataset containing all timesteps, returns a generator that yields
+    masked and dtype-converted data for one timestep (or a small block
+    of timesteps) at a time.
+
+    Data is loaded lazily, and each block is only loaded into memory
+    shortly before it is required. Up to `prefetch` blocks are loaded
+    in the background while the current block is being processed, so
+    at most `prefetch` blocks are held in memory in addition to the
+    block being processed.
+    This allows workflows that process each observation independently
+    to run in constant memory regardless of the length of the time
+    series, e.g.:
+
+        for ds_t in load_ard_iter(dc, products=products, **query):
+            process(ds_t)
+
+    Parameters
+    ----------
+    dc : datacube Datacube object
+        The Datacube to connect to, i.e. `dc = datacube.Datacube()`.
+    time_block : int, optional
+        The number of timesteps to yield at once. Defaults to 1.
+    prefetch : int, optional
+        The number of blocks to load ahead of the block currently
+        being processed. Set to 0 to load each block only when it is
+        requested. Defaults to 2.
+    **kwargs :
+        Parameters to pass to `load_ard`, including `products` and the
+        spatiotemporal query. If `dask_chunks` is not provided, data
+        is chunked with one timestep per chunk.
+
+    Returns
+    -------
+    A generator yielding xarray Datasets containing `time_block`
+    timesteps each.
+
+    """
+
+    # Lazily load data so that only the requested blocks are computed
+    kwargs.setdefault('dask_chunks', {'time': 1})
+    ds = load_ard(dc, **kwargs)
+
+    blocks = (ds.isel(time=slice(i, i + time_block))
+              for i in range(0, len(ds.time), time_block))
+
+    # Without prefetching, load each block only when it is requested
+    if prefetch == 0:
+        for block in blocks:
+            yield block.compute()
+        return
+
+    futures = deque()
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        try:
+            # Start loading the first `prefetch` blocks
+            for block in blocks:
+                futures.append(executor.submit(block.compute))
+                if len(futures) == prefetch:
+                    break
+
+            # Yield the oldest block, replacing it with the next block
+            # so that `prefetch` blocks are loading while it is used
+            while futures:
+                result = futures.popleft().result()
+                block = next(blocks, None)
+                if block is not None:
+                    futures.append(executor.submit(block.compute))
+                yield result
+                del result
+
+        finally:
+            # Cancel any pending loads if the generator is closed early
+            for future in futures:
+                future.cancel()
+
+
+def _cache_time_range(time):
+    """
+    Converts a datacube `time` query (e.g. `('2018-01', '2018-06-15')`
+    or `'2018'`) into inclusive start and end timestamps, using the
+    same rounding as datacube (i.e. '2018' covers the entire year).
+    """
+    start, end = time if isinstance(time, (list, tuple)) else (time, time)
+    return (pd.Period(str(start)).start_time.floor('us'),
+            pd.Period(str(end)).end_time.floor('us'))
+
+
+def _cache_index_path(cache_dir):
+    return os.path.join(cache_dir, 'cache_index.json')
+
+
+def _read_cache_index(cache_dir):
+    """
+    Reads the index of cached segments, returning an empty index if
+    the cache directory does not yet exist.
+    """
+    try:
+        with open(_cache_index_path(cache_dir)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_cache_index(cache_dir, index):
+    """
+    Writes the index of cached segments, replacing the existing index
+    file atomically so it is never left partially written.
+    """
+    tmp_path = f'{_cache_index_path(cache_dir)}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, _cache_index_path(cache_dir))
+
+
+@contextmanager
+def _cache_lock(cache_dir):
+    """
+    Holds an exclusive lock on the cache index while it is read and
+    updated, so that concurrent processes (e.g. several notebooks or
+    dask workers sharing a cache directory) do not overwrite each
+    other's changes. Locking is skipped on platforms without `fcntl`.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+
+    with open(os.path.join(cache_dir, 'cache_index.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, file))
+               for root, _, files in os.walk(path) for file in files)
+
+
+def _sanitise_attrs(ds):
+    """
+    Converts attributes that cannot be serialised to Zarr (e.g. the
+    datacube CRS object in `ds.attrs['crs']`) to strings.
+    """
+    valid_types = (str, int, float, bool, list, tuple, dict,
+                   np.number, np.ndarray)
+    for obj in [ds] + [ds[var] for var in ds.variables]:
+        obj.attrs = {k: v if isinstance(v, valid_types) else str(v)
+                     for k, v in obj.attrs.items()}
+    return ds
+
+
+def _evict_cache(cache_dir, index, max_bytes, keep=(), min_age=3600):
+    """
+    Removes the least recently used cached segments until the total
+    size of the cache is less than `max_bytes`. Segments with paths in
+    `keep` (i.e. those used by the current request), and segments
+    accessed within the last `min_age` seconds (which may still back
+    lazily loaded data returned by a recent request), are never
+    removed.
+    """
+    segments = [(key, seg) for key, segs in index.items() for seg in segs]
+    total = sum(seg['nbytes'] for _, seg in segments)
+
+    for key, seg in sorted(segments, key=lambda i: i[1]['accessed']):
+        if total <= max_bytes:
+            break
+        if (seg['path'] is None or seg['path'] in keep or
+                time.time() - seg['accessed'] < min_age):
+            continue
+        shutil.rmtree(os.path.join(cache_dir, seg['path']),
+                      ignore_errors=True)
+        index[key].remove(seg)
+        total -= seg['nbytes']
+
+    return index
+
+
+def load_ard_cached(dc,
+                    cache_dir='ard_cache',
+                    cache_size='20GB',
+                    refresh_lag='90 days',
+                    cache_key=None,
+                    **kwargs):
+    """
+    Loads data using `load_ard`, storing the loaded and masked results
+    in a local on-disk Zarr cache so that repeated queries can be read
+    back directly from disk rather than being re-loaded and re-masked.
+
+    Results are cached by the combination of datacube index, products,
+    measurements, spatial extent and output grid, and masking options.
+    Each call loads only the parts of the requested `time` range that
+    are not already in the cache, and stores these as new cached
+    segments, so extending a previous query to a longer time range
+    only loads the new period. Once the cache exceeds `cache_size`,
+    the least recently used segments are deleted.
+
+    Data from the most recent `refresh_lag` (i.e. periods for which
+    new observations may still be added to the datacube) is never
+    cached, and is loaded directly using `load_ard` on every call.
+
+    Note that returned data is read lazily from the cache, so will
+    fail to compute if its cached segments are later evicted. Segments
+    used within the last hour are never evicted, but data that needs
+    to be kept for longer should be computed or saved elsewhere.
+
+    Data is always returned lazily as dask arrays.
+
+    Parameters
+    ----------
+    dc : datacube Datacube object
+        The Datacube to connect to, i.e. `dc = datacube.Datacube()`.
+    cache_dir : str, optional
+        The directory in which to store cached data. Defaults to
+        'ard_cache' in the current working directory.
+    cache_size : str or int, optional
+        The maximum size of the cache, either in bytes or as a string
+        (e.g. '20GB', the default).
+    refresh_lag : str, optional
+        Data acquired within this period of the current time (e.g.
+        '90 days', the default) is always re-loaded rather than being
+        read from or added to the cache.
+    cache_key : str, optional
+        An optional string identifying the query, used in addition to
+        the query parameters to identify cached data. This is required
+        if any parameters passed to `load_ard` are functions (e.g.
+        `predicate`), as these cannot be reliably identified.
+    **kwargs :
+        Parameters to pass to `load_ard`, including `products` and a
+        spatial query. A `time` range must be provided.
+
+    Returns
+    -------
+    ds : xarray Dataset
+        An xarray dataset identical to that returned by `load_ard`,
+        backed by dask arrays that point to the on-disk cache.
+
+    """
+
+    if 'time' not in kwargs:
+        raise ValueError("Please provide a `time` range to load")
+
+    # Functions (e.g. `predicate`) have no stable representation, so
+    # cannot be used to identify cached data
+    callables = [k for k, v in kwargs.items() if callable(v)]
+    if callables and cache_key is None:
+        raise ValueError(f"Parameters {callables} are functions and "
+                         f"cannot be used to identify cached data; "
+                         f"please provide a `cache_key`")
+
+    # Separate out time and chunking, which do not affect cached data
+    start, end = _cache_time_range(kwargs.pop('time'))
+    dask_chunks = kwargs.pop('dask_chunks', None) or {'time': 1}
+    query = {k: v for k, v in kwargs.items() if k not in callables}
+    key = hashlib.sha256(
+        repr((_index_id(dc), cache_key,
+              _normalise_query(query))).encode()).hexdigest()[:16]
+
+    # Recent data may still be updated, so is not cached. This is
+    # rounded to the day so that repeated calls share cached segments
+    recent = pd.Timestamp.now().floor('D') - pd.Timedelta(refresh_lag)
+    cache_end = min(end, recent - pd.Timedelta(1, 'us'))
+
+    # Mark existing segments overlapping the requested range as used, so
+    # that they are not evicted by other processes while data is loaded
+    os.makedirs(cache_dir, exist_ok=True)
+    with _cache_lock(cache_dir):
+        index = _read_cache_index(cache_dir)
+        segments = index.get(key, [])
+        for seg in segments:
+            if (pd.Timestamp(seg['end']) >= start and
+                    pd.Timestamp(seg['start']) <= cache_end):
+                seg['accessed'] = time.time()
+        _write_cache_index(cache_dir, index)
+
+    # Identify any gaps in the requested time range that are not
+    # covered by existing cached segments
+    gaps = []
+    cursor = start
+    for seg in sorted(segments, key=lambda i: i['start']):
+        seg_start = pd.Timestamp(seg['start'])
+        seg_end = pd.Timestamp(seg['end'])
+        if seg_end < cursor or seg_start > cache_end:
+            continue
+        if seg_start > cursor:
+            gaps.append((cursor, seg_start - pd.Timedelta(1, 'us')))
+        cursor = max(cursor, seg_end + pd.Timedelta(1, 'us'))
+    if cursor <= cache_end:
+        gaps.append((cursor, cache_end))
+
+    # Load data for each gap and add to the cache as a new segment
+    new_segments = []
+    for gap_start, gap_end in gaps:
+        print(f'Caching data from {gap_start} to {gap_end}')
+        path = None
+        try:
+            ds = load_ard(dc,
+                          time=(gap_start.isoformat(), gap_end.isoformat()),
+                          dask_chunks=dask_chunks,
+                          **kwargs)
+        except ValueError as e:
+            # Record periods with no available data so that these are
+            # not searched for again
+            if 'No data available' not in str(e):
+                raise
+            ds = None
+
+        if ds is not None and len(ds.time) > 0:
+            path = os.path.join(key, f'{uuid.uuid4().hex}.zarr')
+            ds = _sanitise_attrs(ds.chunk({'time': 1}))
+            ds.to_zarr(os.path.join(cache_dir, path), mode='w')
+
+        new_segments.append({'start': gap_start.isoformat(),
+                             'end': gap_end.isoformat(),
+                             'path': path,
+                             'nbytes': (0 if path is None else
+                                        _directory_size(
+                                            os.path.join(cache_dir, path))),
+                             'accessed': time.time()})
+
+    # Add new segments to the index, update access times and remove old
+    # segments if the cache is too large. The index is re-read while
+    # locked so that changes made by other processes are kept
+    with _cache_lock(cache_dir):
+        index = _read_cache_index(cache_dir)
+        key_segments = index.setdefault(key, [])
+        for new_seg in new_segments:
+
+            # Another process may have cached the same period while this
+            # segment was being loaded; if so, keep only the existing one
+            covered = any(
+                pd.Timestamp(seg['start']) <= pd.Timestamp(new_seg['start'])
+                and pd.Timestamp(seg['end']) >= pd.Timestamp(new_seg['end'])
+                for seg in key_segments)
+            if covered:
+                if new_seg['path'] is not None:
+                    shutil.rmtree(os.path.join(cache_dir, new_seg['path']),
+                                  ignore_errors=True)
+            else:
+                key_segments.append(new_seg)
+
+        # Cached segments overlapping the requested range
+        used = [seg for seg in key_segments
+                if seg['path'] is not None and
+                pd.Timestamp(seg['end']) >= start and
+                pd.Timestamp(seg['start']) <= cache_end]
+        for seg in used:
+            seg['accessed'] = time.time()
+        used = [seg['path'] for seg in used]
+
+        index = _evict_cache(cache_dir, index,
+                             max_bytes=dask.utils.parse_bytes(cache_size),
+                             keep=used)
+        _write_cache_index(cache_dir, index)
+
+    # Lazily open all cached segments overlapping the requested range
+    datasets = [xr.open_zarr(os.path.join(cache_dir, path))
+                .sel(time=slice(start, cache_end)) for path in used]
+
+    # Load recent data directly, without caching
+    if end >= recent:
+        print(f'Loading recent data from {max(start, recent)} to {end}')
+        try:
+            datasets.append(load_ard(dc,
+                                     time=(max(start, recent).isoformat(),
+                                           end.isoformat()),
+                                     dask_chunks=dask_chunks,
+                                     **kwargs))
+        except ValueError as e:
+            if 'No data available' not in str(e):
+                raise
+
+    if len(datasets) == 0:
+        raise ValueError("No data available for query: ensure that "
+                         "the products specified have data for the "
+                         "time and location requested")
+
+    # Combine segments into a single dataset, dropping any timesteps
+    # stored in more than one overlapping segment, and restore CRS info
+    ds = xr.concat(datasets, dim='time').sortby('time')
+    ds = ds.isel(time=~ds.get_index('time').duplicated())
+    ds = assign_crs(ds, str(ds.attrs['crs'])) if 'crs' in ds.attrs else ds
+    print(f'Returning {len(ds.time)} time steps as a dask array')
+
+    return ds
+
+
 def array_to_geotiff(fname, data, geo_transform, projection,
                      nodata_val=0, dtype=gdal.GDT_Float32):
     """
@@ -458,6 +1473,10 @@ def array_to_geotiff(fname, data, geo_transform, projection,
         geotrans = xarraydataset.geobox.transform.to_gdal()
         prj = xarraydataset.geobox.crs.wkt
 
+    To write multi-band or large (e.g. dask) xarray data to a tiled,
+    compressed GeoTIFF without loading it into memory, use
+    `xr_to_geotiff` instead.
+
     Parameters
     ----------
     fname : str
@@ -496,6 +1515,226 @@ def array_to_geotiff(fname, data, geo_transform, projection,
     dataset = None
 
 
+# Mapping between numpy and GDAL data types
+_GDAL_DTYPES = {'bool': gdal.GDT_Byte,
+                'uint8': gdal.GDT_Byte,
+                'int8': gdal.GDT_Int16,
+                'uint16': gdal.GDT_UInt16,
+                'int16': gdal.GDT_Int16,
+                'uint32': gdal.GDT_UInt32,
+                'int32': gdal.GDT_Int32,
+                'float16': gdal.GDT_Float32,
+                'float32': gdal.GDT_Float32,
+                'float64': gdal.GDT_Float64}
+
+# 64-bit integer rasters are only supported by GDAL >= 3.5
+if hasattr(gdal, 'GDT_Int64'):
+    _GDAL_DTYPES.update({'int64': gdal.GDT_Int64,
+                         'uint64': gdal.GDT_UInt64})
+
+
+class _GDALBlockWriter:
+    """
+    A target for `dask.array.store` that writes each (band, y, x) block
+    it receives into the matching window of an open GDAL dataset.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __setitem__(self, key, block):
+        band_slice, y_slice, x_slice = key
+        for i, band in enumerate(range(band_slice.start, band_slice.stop)):
+            self.dataset.GetRasterBand(band + 1).WriteArray(
+                block[i], xoff=x_slice.start, yoff=y_slice.start)
+
+
+def _store_blocks(array, target):
+    """
+    Computes the blocks of a dask array in parallel, writing each to
+    `target` (e.g. a `_GDALBlockWriter`) as soon as it is ready.
+
+    Open GDAL datasets cannot be sent to the worker processes of a dask
+    distributed cluster, so if a distributed client is active, blocks
+    are computed on the cluster and written from the client process.
+    Otherwise, blocks are computed and written by the local threaded
+    scheduler using `dask.array.store`.
+    """
+    try:
+        from distributed import get_client, as_completed
+        client = get_client()
+    except (ImportError, ValueError):
+        da.store(array, target, lock=True, scheduler="threads")
+        return
+
+    # Location of each block within the full array
+    offsets = [[int(o) for o in np.cumsum((0,) + chunks)]
+               for chunks in array.chunks]
+    block_ids = list(np.ndindex(*array.numblocks))
+    delayed_blocks = array.to_delayed()
+    futures = client.compute([delayed_blocks[i] for i in block_ids])
+    slices = {future.key: tuple(slice(offsets[d][i[d]], offsets[d][i[d] + 1])
+                                for d in range(array.ndim))
+              for future, i in zip(futures, block_ids)}
+
+    for future, block in as_completed(futures, with_results=True):
+        target[slices[future.key]] = block
+        future.release()
+
+
+def xr_to_geotiff(ds,
+                  fname,
+                  compress='deflate',
+                  predictor=None,
+                  blocksize=512,
+                  overviews=True,
+                  overview_resampling='average',
+                  cog=False,
+                  nodata=None):
+    """
+    Writes a multi-band xarray Dataset or DataArray to a tiled,
+    compressed GeoTIFF (or Cloud Optimised GeoTIFF) file.
+
+    Unlike `array_to_geotiff`, data does not need to be loaded into
+    memory first: dask-backed data is computed block-by-block in
+    parallel, and each block is written to the output file as soon as
+    it has been computed. When using a dask distributed cluster (e.g.
+    from `dea_dask.create_local_dask_cluster`), blocks are computed on
+    the cluster and written to file by the notebook process, as open
+    GDAL datasets cannot be shared with cluster workers. Each variable
+    in a Dataset (or each slice along the first dimension of a 3D
+    DataArray) is written as a separate band.
+
+    Parameters
+    ----------
+    ds : xarray Dataset or DataArray
+        A 2D (y, x) or 3D (band, y, x) DataArray, or a Dataset of 2D
+        variables, to write to file. The data must have georeferencing
+        information, e.g. as returned by `dc.load` or `load_ard`.
+    fname : str
+        Output GeoTIFF file path including extension.
+    compress : str, optional
+        The compression to use, e.g. 'deflate' (the default), 'zstd',
+        'lzw', or None for no compression.
+    predictor : int, optional
+        The compression predictor to use. Defaults to None, which uses
+        horizontal differencing (2) for integer data and floating point
+        prediction (3) for float data; this typically makes compressed
+        files substantially smaller.
+    blocksize : int, optional
+        The size of the internal tiles of the output file in pixels.
+        Defaults to 512.
+    overviews : bool, optional
+        Whether to add overviews (reduced resolution versions of the
+        data) to the file. Defaults to True.
+    overview_resampling : str, optional
+        The resampling method used to generate overviews, e.g.
+        'average' (the default) or 'nearest' (for categorical data).
+    cog : bool, optional
+        Whether to write the output as a Cloud Optimised GeoTIFF.
+        Defaults to False.
+    nodata : int or float, optional
+        The nodata value to set for all bands of the output file.
+        Defaults to None, which uses the `nodata` attribute of each
+        band (i.e. each Dataset variable) if it exists. Note that
+        GeoTIFF files can only store a single nodata value.
+
+    """
+
+    # Convert input to a 3D (band, y, x) array
+    geobox = ds.geobox
+    if isinstance(ds, xr.Dataset):
+        band_attrs = [ds[var].attrs for var in ds.data_vars]
+        array = ds.to_array(dim='band')
+    else:
+        array = ds if ds.ndim == 3 else ds.expand_dims('band')
+        band_attrs = [ds.attrs] * array.shape[0]
+    band_nodata = [nodata if nodata is not None else attrs.get('nodata')
+                   for attrs in band_attrs]
+    if len(set(i for i in band_nodata if i is not None)) > 1:
+        warnings.warn('Bands have different nodata values, but GeoTIFF '
+                      'files can only store a single nodata value; GDAL '
+                      'will report the value of the last band for all '
+                      'bands when the file is re-opened')
+    array = array.data
+    if np.dtype(array.dtype).name not in _GDAL_DTYPES:
+        raise ValueError(f'Data type {array.dtype} can not be written to '
+                         f'GeoTIFF; supported types are '
+                         f'{", ".join(_GDAL_DTYPES)}')
+
+    # Promote types that GDAL cannot write directly
+    if array.dtype == bool:
+        array = array.astype(np.uint8)
+    elif array.dtype == np.float16:
+        array = array.astype(np.float32)
+
+    # Rechunk so that chunks cover a whole number of output tiles, so
+    # that each tile is written by a single task
+    if not dask.is_dask_collection(array):
+        array = da.from_array(array, chunks=(1, 4 * blocksize,
+                                             4 * blocksize))
+    y_chunk, x_chunk = [max(1, round(c / blocksize)) * blocksize
+                        for c in array.chunksize[1:]]
+    array = array.rechunk({1: y_chunk, 2: x_chunk})
+
+    # Set up creation options for a tiled, compressed GeoTIFF
+    bands, rows, cols = array.shape
+    options = ['TILED=YES',
+               f'BLOCKXSIZE={blocksize}',
+               f'BLOCKYSIZE={blocksize}',
+               'BIGTIFF=IF_SAFER']
+    if compress:
+        if predictor is None:
+            predictor = 3 if np.issubdtype(array.dtype, np.floating) else 2
+        options += [f'COMPRESS={compress.upper()}',
+                    f'PREDICTOR={predictor}']
+
+    # If writing a COG, first write to a temporary file that will be
+    # copied to the final output once overviews are added
+    out_fname = f'{fname}.tmp.tif' if cog else fname
+
+    # Create raster of given size and projection
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(out_fname, cols, rows, bands,
+                            _GDAL_DTYPES[np.dtype(array.dtype).name],
+                            options=options)
+    dataset.SetGeoTransform(geobox.transform.to_gdal())
+    dataset.SetProjection(geobox.crs.wkt)
+
+    # Set nodata and any scale/offset encoding for each band
+    for band, (attrs, band_nd) in enumerate(zip(band_attrs, band_nodata),
+                                            start=1):
+        raster_band = dataset.GetRasterBand(band)
+        if band_nd is not None:
+            raster_band.SetNoDataValue(float(band_nd))
+        if 'scale_factor' in attrs:
+            raster_band.SetScale(float(attrs['scale_factor']))
+        if 'add_offset' in attrs:
+            raster_band.SetOffset(float(attrs['add_offset']))
+
+    # Compute blocks in parallel, writing each as soon as it is ready
+    print(f'Writing {bands} band(s) to {fname}')
+    _store_blocks(array, _GDALBlockWriter(dataset))
+
+    # Add overviews, halving resolution until they fit in a single tile
+    if overviews:
+        levels = []
+        while max(rows, cols) / 2 ** len(levels) > blocksize:
+            levels.append(2 ** (len(levels) + 1))
+        if levels:
+            dataset.BuildOverviews(overview_resampling.upper(), levels)
+
+    # Close file
+    dataset = None
+
+    # Copy to a Cloud Optimised GeoTIFF with overviews and tiles
+    # arranged for efficient access
+    if cog:
+        gdal.Translate(fname, out_fname,
+                       creationOptions=options + ['COPY_SRC_OVERVIEWS=YES'])
+        os.remove(out_fname)
+
+
 def mostcommon_crs(dc, product, query):
     """
     Takes a given query and returns the most common CRS for observations
@@ -542,13 +1781,114 @@ def mostcommon_crs(dc, product, query):
     return crs_mostcommon
 
 
+def _file_checksum(fname, algorithm='sha256', chunk_size=2 ** 20):
+    """
+    Computes the checksum of a file without reading it into memory.
+    """
+    file_hash = hashlib.new(algorithm)
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def _file_crc32(fname, chunk_size=2 ** 20):
+    """
+    Calculates the CRC-32 checksum of a file (as stored for each member
+    of a zip archive), reading the file in chunks.
+    """
+    crc = 0
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def _download_stream(url, fname, chunk_size=2 ** 20):
+    """
+    Streams a URL to `fname` in chunks, writing to a temporary '.part'
+    file. If a partial download from a previous attempt exists, the
+    download is resumed from where it stopped using an HTTP range
+    request.
+    """
+
+    part_name = f'{fname}.part'
+    offset = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+    with requests.get(url, headers=headers, stream=True) as r:
+
+        # A 416 status means the partial file is already complete
+        if r.status_code == 416:
+            os.replace(part_name, fname)
+            return
+        r.raise_for_status()
+
+        # Append if the server honoured the range request, otherwise
+        # start again from the beginning
+        if offset and r.status_code == 206:
+            print(f'Resuming download from {offset / 2 ** 20:.1f} MB')
+            mode = 'ab'
+        else:
+            mode = 'wb'
+
+        with open(part_name, mode) as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+
+    os.replace(part_name, fname)
+
+
+def _download_parts(url, fname, size, n_parts, chunk_size=2 ** 20):
+    """
+    Downloads a URL to `fname` as `n_parts` byte ranges fetched in
+    parallel, each written directly to its position in the file.
+    """
+
+    part_name = f'{fname}.part'
+    with open(part_name, 'wb') as f:
+        f.truncate(size)
+
+    def _fetch(start, end):
+        headers = {'Range': f'bytes={start}-{end}'}
+        with requests.get(url, headers=headers, stream=True) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise ValueError(f'Server did not honour range request '
+                                 f'for bytes {start}-{end} of {url}')
+            with open(part_name, 'r+b') as f:
+                f.seek(start)
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+
+    # Split file into approximately equal byte ranges
+    bounds = np.linspace(0, size, n_parts + 1).astype(int)
+    with ThreadPoolExecutor(max_workers=n_parts) as executor:
+        futures = [executor.submit(_fetch, start, end - 1)
+                   for start, end in zip(bounds[:-1], bounds[1:])
+                   if end > start]
+        for future in futures:
+            future.result()
+
+    os.replace(part_name, fname)
+
+
 def download_unzip(url,
                    output_dir=None,
-                   remove_zip=True):
+                   remove_zip=True,
+                   checksum=None,
+                   n_parts=1,
+                   cache_dir=None,
+                   chunk_size=2 ** 20):
     """
     Downloads and unzips a .zip file from an external URL to a local
     directory.
 
+    The file is streamed to disk in chunks rather than being held in
+    memory, so large files can be downloaded safely. Interrupted
+    downloads are resumed from where they stopped the next time the
+    function is run.
+
     Parameters
     ----------
     url : str
@@ -561,7 +1901,26 @@ def download_unzip(url,
     remove_zip : bool, optional
         An optional boolean indicating whether to remove the downloaded
         .zip file after files are unzipped. Defaults to True, which will
-        delete the .zip file.
+        delete the .zip file. Ignored if `cache_dir` is provided.
+    checksum : str, optional
+        An optional checksum used to verify the downloaded file, either
+        as a hex digest of the file's SHA-256 hash, or in the form
+        'algorithm:hexdigest' (e.g. 'md5:9e107d9d372bb6826bd81d3542a419d6').
+        A ValueError is raised if the downloaded file does not match.
+    n_parts : int, optional
+        An optional number of byte ranges to download in parallel.
+        Defaults to 1, which downloads the file in a single stream.
+        If the server does not support range requests, the file is
+        downloaded in a single stream.
+    cache_dir : str, optional
+        An optional directory in which to keep downloaded files, named
+        by the SHA-256 hash of their contents. If a file from the same
+        URL (or with the same checksum) has already been downloaded, it
+        will be re-used instead of being downloaded again. Defaults to
+        None, which does not cache downloads.
+    chunk_size : int, optional
+        The number of bytes to write to disk at a time. Defaults to
+        1 MB.
 
     """
 
@@ -574,34 +1933,180 @@ def download_unzip(url,
                          f'file (e.g. {zip_name}). Please specify a '
                          f'URL path to a valid .zip file')
 
-    # Download zip file
-    print(f'Downloading {zip_name}')
-    r = requests.get(url)
-    with open(zip_name, 'wb') as f:
-        f.write(r.content)
+    # Parse checksum into an algorithm and expected hex digest
+    if checksum is not None:
+        algorithm, _, expected = checksum.rpartition(':')
+        algorithm = algorithm.lower() or 'sha256'
+        expected = expected.lower()
+
+    # Look up file in cache using its checksum (if provided) or the
+    # hash recorded for this URL by a previous download
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        index_path = os.path.join(cache_dir, 'download_index.json')
+        index = {}
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+        if checksum is not None and algorithm == 'sha256':
+            content_hash = expected
+        else:
+            content_hash = index.get(url)
+        cached_name = os.path.join(cache_dir, f'{content_hash}.zip')
+        if content_hash and os.path.exists(cached_name):
+            print(f'Using cached copy of {zip_name}')
+            zip_name = cached_name
+            checksum = None
+        else:
+            zip_name = os.path.join(cache_dir, zip_name)
+            content_hash = None
 
-    # Extract into output_dir
+    # Download zip file
+    if cache_dir is None or content_hash is None:
+        print(f'Downloading {zip_name}')
+
+        # Use a parallel download if the server supports range requests
+        size = None
+        if n_parts > 1:
+            head = requests.head(url, allow_redirects=True)
+            if (head.headers.get('Accept-Ranges') == 'bytes' and
+                    'Content-Length' in head.headers):
+                size = int(head.headers['Content-Length'])
+
+        if size:
+            _download_parts(url, zip_name, size, n_parts, chunk_size)
+        else:
+            _download_stream(url, zip_name, chunk_size)
+
+    # Verify checksum
+    if checksum is not None:
+        digest = _file_checksum(zip_name, algorithm)
+        if digest != expected:
+            os.remove(zip_name)
+            raise ValueError(f'The {algorithm} checksum of the downloaded '
+                             f'file ({digest}) does not match the '
+                             f'expected checksum ({expected})')
+
+    # Move newly downloaded file to its content-addressed cache location
+    if cache_dir is not None and content_hash is None:
+        content_hash = _file_checksum(zip_name, 'sha256')
+        cached_name = os.path.join(cache_dir, f'{content_hash}.zip')
+        os.replace(zip_name, cached_name)
+        zip_name = cached_name
+        index[url] = content_hash
+        with open(index_path, 'w') as f:
+            json.dump(index, f, indent=2)
+
+    # Extract into output_dir one member at a time, skipping any files
+    # already extracted by a previous run with identical contents
+    print(f'Unzipping output files to: '
+          f'{output_dir if output_dir else os.getcwd()}')
     with zipfile.ZipFile(zip_name, 'r') as zip_ref:
-        zip_ref.extractall(output_dir)
-        print(f'Unzipping output files to: '
-              f'{output_dir if output_dir else os.getcwd()}')
+        for member in zip_ref.infolist():
+            out_path = os.path.join(output_dir or '', member.filename)
+            if (not member.is_dir() and os.path.exists(out_path) and
+                    os.path.getsize(out_path) == member.file_size and
+                    _file_crc32(out_path, chunk_size) == member.CRC):
+                continue
+            zip_ref.extract(member, output_dir)
 
     # Optionally cleanup
-    if remove_zip:
+    if remove_zip and cache_dir is None:
         os.remove(zip_name)
 
 
+def _fuse_bitflags(dest, src, nodata_bit=0):
+    """
+    Fuses `src` into `dest` in-place, branch-free, for bit-flag arrays
+    where `nodata_bit` is set on pixels with no data. Pixels that are
+    empty in `dest` take the value from `src`, and pixels that are
+    valid in both arrays have their flags combined with a bitwise OR.
+    """
+
+    # All-ones mask where `dest` is empty
+    empty = dest >> nodata_bit
+    empty &= 1
+    np.negative(empty, out=empty)
+
+    # Flags from `src` where `src` is valid, OR-ed into `dest`
+    valid_src = src >> nodata_bit
+    valid_src &= 1
+    np.negative(valid_src, out=valid_src)
+    np.invert(valid_src, out=valid_src)
+    valid_src &= src
+    dest |= valid_src
+
+    # Replace empty pixels in `dest` with `src`, re-using the same
+    # buffer for `dest ^ src` to avoid another allocation
+    np.bitwise_xor(dest, src, out=valid_src)
+    valid_src &= empty
+    dest ^= valid_src
+
+
+def bitflag_fuser(nodata_bit=0):
+    """
+    Creates a fuse function for combining overlapping observations of
+    bit-flag products (e.g. WOfS) when loading data with `dc.load`
+    and `group_by='solar_day'`.
+
+    Pixels that are nodata in the first observation take the value of
+    the second, and pixels that are valid in both have their flags
+    combined with a bitwise OR. Fusing is performed in-place using
+    bitwise operations, without boolean indexing.
+
+    Example use :
+
+        fuse_func = bitflag_fuser(nodata_bit=0)
+        ds = dc.load(product='ga_ls_wo_3', fuse_func=fuse_func, ...)
+
+    Parameters
+    ----------
+    nodata_bit : int, optional
+        The bit that is set on pixels containing no data. Defaults to
+        0, as used by WOfS.
+
+    Returns
+    -------
+    fuser : function
+        A function with the signature `fuser(dest, src)` that fuses
+        `src` into `dest` in-place, suitable for use as `fuse_func`.
+
+    """
+
+    def fuser(dest, src):
+        _fuse_bitflags(dest, src, nodata_bit)
+
+    return fuser
+
+
 def wofs_fuser(dest, src):
     """
     Fuse two WOfS water measurements represented as `ndarray`s.
 
-    Note: this is a copy of the function located here:
+    Note: this is a vectorised, in-place equivalent of the function
+    located here:
     https://github.com/GeoscienceAustralia/digitalearthau/blob/develop/digitalearthau/utils.py
     """
-    empty = (dest & 1).astype(np.bool)
-    both = ~empty & ~((src & 1).astype(np.bool))
-    dest[empty] = src[empty]
-    dest[both] |= src[both]
+    _fuse_bitflags(dest, src, nodata_bit=0)
+
+
+def _dilate_block(array, dilation):
+    """
+    Dilates True pixels in each 2D (y, x) slice of a boolean array by
+    thresholding the Euclidean distance to the nearest True pixel.
+    This gives the same result as a binary dilation with a disk-like
+    kernel of radius `dilation + 0.5`, but its cost does not grow with
+    the size of the kernel.
+    """
+
+    out = np.empty(array.shape, dtype=bool)
+    for idx in np.ndindex(array.shape[:-2]):
+        plane = array[idx]
+        if not plane.any() or plane.all():
+            out[idx] = plane
+        else:
+            out[idx] = distance_transform_edt(~plane) <= dilation + 0.5
+    return out
 
 
 def dilate(array, dilation=10, invert=True):
@@ -614,10 +2119,16 @@ def dilate(array, dilation=10, invert=True):
     buffer around cloudy or shadowed pixels). This functionality can
     be reversed by specifying `invert=False`.
 
+    Dilation is applied to each 2D slice along the last two (y, x)
+    dimensions of the array. Dask arrays (and xarray DataArrays
+    containing dask arrays) are dilated lazily, chunk by chunk, with
+    an overlap of `dilation` pixels between neighbouring chunks.
+
     Parameters
     ----------
     array : array
-        The binary array to dilate.
+        The binary array to dilate. This can be a numpy array, dask
+        array or xarray DataArray.
     dilation : int, optional
         An optional integer specifying the number of pixels to dilate
         by. Defaults to 10, which will dilate `array` by 10 pixels.
@@ -628,65 +2139,170 @@ def dilate(array, dilation=10, invert=True):
 
     Returns
     -------
-    An array of the same shape as `array`, with valid data pixels
-    dilated by the number of pixels specified by `dilation`.
+    An array of the same shape and type as `array`, with valid data
+    pixels dilated by the number of pixels specified by `dilation`.
     """
 
-    y, x = np.ogrid[
-        -dilation: (dilation + 1),
-        -dilation: (dilation + 1),
-    ]
-
-    # disk-like radial dilation
-    kernel = (x * x) + (y * y) <= (dilation + 0.5) ** 2
+    # Apply to underlying data of xarray objects, returning the same type
+    if isinstance(array, xr.DataArray):
+        return array.copy(data=dilate(array.data, dilation, invert))
 
     # If invert=True, invert True values to False etc
     if invert:
         array = ~array
+    array = array.astype(bool)
+
+    if dask.is_dask_collection(array):
+        depth = {axis: (dilation if axis >= array.ndim - 2 else 0)
+                 for axis in range(array.ndim)}
+        dilated = array.map_overlap(_dilate_block,
+                                    depth=depth,
+                                    boundary='none',
+                                    dtype=bool,
+                                    dilation=dilation)
+    else:
+        dilated = _dilate_block(array, dilation)
 
-    return ~binary_dilation(array.astype(np.bool),
-                            structure=kernel.reshape((1,) + kernel.shape))
+    return ~dilated
 
 
-def pan_sharpen_brovey(band_1, band_2, band_3, pan_band):
+def _brovey_block(band_1, band_2, band_3, pan_band, upsample=1,
+                  out_dtype=None):
+    """
+    Brovey pan-sharpens a single block of data, returning the three
+    sharpened bands stacked along a new first axis. If `upsample` is
+    greater than 1, the multispectral bands are at a resolution
+    `upsample` times coarser than `pan_band`, and are upsampled using
+    nearest neighbour resampling without being copied.
     """
-    Brovey pan sharpening on surface reflectance input using numexpr
-    and return three xarrays.
+
+    # Compute in at least float32 precision
+    calc_dtype = np.result_type(band_1, band_2, band_3, pan_band,
+                                np.float32)
+    dtype = np.dtype(out_dtype or calc_dtype)
+
+    # View pan band so that each multispectral pixel broadcasts across
+    # the `upsample` x `upsample` block of pan pixels it covers
+    *other, rows, cols = band_1.shape
+    pan_view = pan_band.reshape(
+        (*other, rows, upsample, cols, upsample))
+    sharpened = np.empty((3, *pan_band.shape), dtype=dtype)
+    sharpened_view = sharpened.reshape((3, *pan_view.shape))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        # Inverse of total at multispectral resolution
+        inv_total = np.add(band_1, band_2, dtype=calc_dtype)
+        inv_total += band_3
+        np.reciprocal(inv_total, out=inv_total)
+
+        # Brovey Transform in form of: band/total*panchromatic
+        for i, band in enumerate((band_1, band_2, band_3)):
+            ratio = (band * inv_total)[..., :, None, :, None]
+            if dtype == calc_dtype:
+                np.multiply(ratio, pan_view, out=sharpened_view[i])
+            else:
+                band_sharpened = ratio * pan_view
+                if np.issubdtype(dtype, np.integer):
+                    np.rint(band_sharpened, out=band_sharpened)
+                sharpened_view[i] = band_sharpened
+
+    return sharpened
+
+
+def pan_sharpen_brovey(band_1,
+                       band_2,
+                       band_3,
+                       pan_band,
+                       dtype=None,
+                       upsample=1):
+    """
+    Brovey pan sharpening on surface reflectance input, computed for
+    all three bands in a single pass over the data.
+
+    If any of the inputs are dask arrays (or xarray.DataArrays
+    containing dask arrays), pan sharpening is performed lazily,
+    chunk by chunk.
 
     Parameters
     ----------
-    band_1, band_2, band_3 : xarray.DataArray or numpy.array
-        Three input multispectral bands, either as xarray.DataArrays or
-        numpy.arrays. These bands should have already been resampled to
-        the spatial resolution of the panchromatic band.
-    pan_band : xarray.DataArray or numpy.array
+    band_1, band_2, band_3 : xarray.DataArray, numpy.array or dask.array
+        Three input multispectral bands, either as xarray.DataArrays,
+        numpy.arrays or dask.arrays. These bands should either have
+        already been resampled to the spatial resolution of the
+        panchromatic band, or be at a resolution exactly `upsample`
+        times coarser than the panchromatic band.
+    pan_band : xarray.DataArray, numpy.array or dask.array
         A panchromatic band corresponding to the above multispectral
         bands that will be used to pan-sharpen the data.
+    dtype : str or numpy.dtype, optional
+        An optional data type for the outputs, e.g. 'float32' or
+        'int16' (integer outputs are rounded to the nearest integer).
+        Defaults to None, which returns float32 outputs (or float64
+        if any input is float64).
+    upsample : int, optional
+        An optional integer factor by which the multispectral bands are
+        coarser than the panchromatic band (e.g. 2 for 30 m Landsat
+        multispectral bands and a 15 m panchromatic band). The
+        multispectral bands are upsampled to the resolution of
+        `pan_band` using nearest neighbour resampling as part of the
+        same pass. Defaults to 1, which requires all bands to be at the
+        same resolution.
 
     Returns
     -------
     band_1_sharpen, band_2_sharpen, band_3_sharpen : numpy.arrays
-        Three numpy arrays equivelent to `band_1`, `band_2` and `band_3`
+        Three numpy arrays (or dask arrays if the inputs contained dask
+        arrays) equivelent to `band_1`, `band_2` and `band_3`
         pan-sharpened to the spatial resolution of `pan_band`.
 
     """
-    # Calculate total
-    exp = 'band_1 + band_2 + band_3'
-    total = numexpr.evaluate(exp)
 
-    # Perform Brovey Transform in form of: band/total*panchromatic
-    exp = 'a/b*c'
-    band_1_sharpen = numexpr.evaluate(exp, local_dict={'a': band_1,
-                                                       'b': total,
-                                                       'c': pan_band})
-    band_2_sharpen = numexpr.evaluate(exp, local_dict={'a': band_2,
-                                                       'b': total,
-                                                       'c': pan_band})
-    band_3_sharpen = numexpr.evaluate(exp, local_dict={'a': band_3,
-                                                       'b': total,
-                                                       'c': pan_band})
+    # Extract underlying arrays from xarray inputs
+    bands = [band.data if isinstance(band, xr.DataArray) else band
+             for band in (band_1, band_2, band_3, pan_band)]
+
+    # Verify that pan band is `upsample` times the size of other bands
+    *other, rows, cols = bands[0].shape
+    if bands[3].shape != (*other, rows * upsample, cols * upsample):
+        raise ValueError(f'The shape of `pan_band` {bands[3].shape} is '
+                         f'not {upsample} times the size of the '
+                         f'multispectral bands {bands[0].shape}. Please '
+                         f'check the resolution of the inputs and the '
+                         f'`upsample` parameter.')
+
+    if any(dask.is_dask_collection(band) for band in bands):
+
+        # Chunk multispectral bands identically, and pan band so that
+        # each of its chunks covers the same area
+        *ms_bands, pan = [da.asarray(band) for band in bands]
+        ms_bands = [band.rechunk(ms_bands[0].chunks) for band in ms_bands]
+        ms_chunks = ms_bands[0].chunks
+        pan = pan.rechunk(ms_chunks[:-2] +
+                          tuple(tuple(c * upsample for c in chunks)
+                                for chunks in ms_chunks[-2:]))
+
+        # Apply block-by-block, matching blocks by position rather than
+        # by chunk size so that multispectral and pan blocks can differ
+        out_dtype = np.dtype(dtype or np.result_type(*bands, np.float32))
+        index = tuple(f'dim_{i}' for i in range(pan.ndim))
+        sharpened = da.blockwise(_brovey_block,
+                                 ('band',) + index,
+                                 *[arg for band in ms_bands + [pan]
+                                   for arg in (band, index)],
+                                 upsample=upsample,
+                                 out_dtype=out_dtype,
+                                 dtype=out_dtype,
+                                 new_axes={'band': 3},
+                                 adjust_chunks=dict(zip(index, pan.chunks)),
+                                 align_arrays=False,
+                                 concatenate=True,
+                                 meta=np.array((), dtype=out_dtype))
+    else:
+        sharpened = _brovey_block(*bands, upsample=upsample,
+                                  out_dtype=dtype)
 
-    return band_1_sharpen, band_2_sharpen, band_3_sharpen
+    return sharpened[0], sharpened[1], sharpened[2]
 
 
 def paths_to_datetimeindex(paths, string_slice=(0, 10)):
@@ -715,10 +2331,84 @@ def paths_to_datetimeindex(paths, string_slice=(0, 10)):
     return pd.to_datetime(date_strings)
 
 
-def _select_along_axis(values, idx, axis):
-    other_ind = np.ix_(*[np.arange(s) for s in idx.shape])
-    sl = other_ind[:axis] + (idx,) + other_ind[axis:]
-    return values[sl]
+def _first_index(values):
+    """
+    Returns the index of the first non-null value along the last axis.
+    """
+    return np.argmax(~pd.isnull(values), axis=-1)
+
+
+def _last_index(values):
+    """
+    Returns the (negative) index of the last non-null value along the
+    last axis.
+    """
+    return -1 - np.argmax(~pd.isnull(values[..., ::-1]), axis=-1)
+
+
+def _previous_valid_index(values):
+    """
+    Returns the index of the closest non-null value at or before each
+    position along the last axis, or -1 if there are none.
+    """
+    positions = np.arange(values.shape[-1], dtype=np.int32)
+    idx = np.where(~pd.isnull(values), positions, -1)
+    return np.maximum.accumulate(idx, axis=-1)
+
+
+def _next_valid_index(values):
+    """
+    Returns the index of the closest non-null value at or after each
+    position along the last axis, or the length of the axis if there
+    are none.
+    """
+    n = values.shape[-1]
+    positions = np.arange(n, dtype=np.int32)
+    idx = np.where(~pd.isnull(values), positions, n)[..., ::-1]
+    return np.minimum.accumulate(idx, axis=-1)[..., ::-1]
+
+
+def _take_along_last_axis(values, idx):
+    """
+    Selects one value along the last axis of `values` for each element
+    of `idx`.
+    """
+    return np.take_along_axis(values, idx[..., np.newaxis], axis=-1)[..., 0]
+
+
+def _reduce_by_index(array, dim, idx, index_name=None):
+    """
+    Reduces `array` along `dim` by selecting the value at the index
+    given by `idx` for each pixel. The `dim` dimension is replaced by a
+    coord containing the value of `dim` at each selected index.
+    """
+    reduced = xr.apply_ufunc(_take_along_last_axis,
+                             array, idx,
+                             input_core_dims=[[dim], []],
+                             dask='parallelized',
+                             output_dtypes=[array.dtype])
+    coord = array[dim].values
+    reduced[dim] = xr.apply_ufunc(lambda i: coord[i],
+                                  idx,
+                                  dask='parallelized',
+                                  output_dtypes=[coord.dtype])
+    if index_name is not None:
+        reduced[index_name] = idx
+    return reduced
+
+
+def _index_along(array, dim, func, dtype, keep_dim=False):
+    """
+    Applies an index-finding function along `dim` for every pixel,
+    block by block if `array` is a dask array (which must have a single
+    chunk along `dim`). If `keep_dim=True`, `func` returns an index
+    for every position along `dim` rather than reducing it.
+    """
+    return xr.apply_ufunc(func, array,
+                          input_core_dims=[[dim]],
+                          output_core_dims=[[dim] if keep_dim else []],
+                          dask='parallelized',
+                          output_dtypes=[dtype])
 
 
 def first(array: xr.DataArray,
@@ -727,6 +2417,9 @@ def first(array: xr.DataArray,
     """
     Finds the first occuring non-null value along the given dimension.
 
+    Supports both numpy and dask-backed arrays; dask arrays are
+    processed block-by-block without being computed.
+
     Parameters
     ----------
     array : xr.DataArray
@@ -734,6 +2427,9 @@ def first(array: xr.DataArray,
     dim : str
         The name of the dimension to reduce by finding the first
         non-null value.
+    index_name : str, optional
+        If given, the name of a coordinate to be added containing the
+        index of where on the dimension the first value was found.
 
     Returns
     -------
@@ -744,14 +2440,10 @@ def first(array: xr.DataArray,
         the last value was found.
     """
 
-    axis = array.get_axis_num(dim)
-    idx_first = np.argmax(~pd.isnull(array), axis=axis)
-    reduced = array.reduce(_select_along_axis, idx=idx_first, axis=axis)
-    reduced[dim] = array[dim].isel({dim: xr.DataArray(idx_first,
-                                                      dims=reduced.dims)})
-    if index_name is not None:
-        reduced[index_name] = xr.DataArray(idx_first, dims=reduced.dims)
-    return reduced
+    if dask.is_dask_collection(array):
+        array = array.chunk({dim: -1})
+    idx_first = _index_along(array, dim, _first_index, np.int64)
+    return _reduce_by_index(array, dim, idx_first, index_name)
 
 
 def last(array: xr.DataArray,
@@ -760,6 +2452,9 @@ def last(array: xr.DataArray,
     """
     Finds the last occuring non-null value along the given dimension.
 
+    Supports both numpy and dask-backed arrays; dask arrays are
+    processed block-by-block without being computed.
+
     Parameters
     ----------
     array : xr.DataArray
@@ -780,15 +2475,10 @@ def last(array: xr.DataArray,
         the last value was found.
     """
 
-    axis = array.get_axis_num(dim)
-    rev = (slice(None),) * axis + (slice(None, None, -1),)
-    idx_last = -1 - np.argmax(~pd.isnull(array)[rev], axis=axis)
-    reduced = array.reduce(_select_along_axis, idx=idx_last, axis=axis)
-    reduced[dim] = array[dim].isel({dim: xr.DataArray(idx_last,
-                                                      dims=reduced.dims)})
-    if index_name is not None:
-        reduced[index_name] = xr.DataArray(idx_last, dims=reduced.dims)
-    return reduced
+    if dask.is_dask_collection(array):
+        array = array.chunk({dim: -1})
+    idx_last = _index_along(array, dim, _last_index, np.int64)
+    return _reduce_by_index(array, dim, idx_last, index_name)
 
 
 def nearest(array: xr.DataArray,
@@ -809,14 +2499,21 @@ def nearest(array: xr.DataArray,
     The returned array will include the 'time' coordinate for each x,y
     pixel that the nearest value was found.
 
+    Multiple target labels can be supplied at once (e.g. one for each
+    month of a year) to return an array with an additional 'target'
+    dimension, with one set of nearest values for each target. The
+    array is only scanned once regardless of the number of targets.
+    Supports both numpy and dask-backed arrays; dask arrays are
+    processed block-by-block without being computed.
+
     Parameters
     ----------
     array : xr.DataArray
          The array to search.
     dim : str
         The name of the dimension to look for the target label.
-    target : same type as array[dim]
-        The value to look up along the given dimension.
+    target : same type as array[dim], or list of these
+        The value (or values) to look up along the given dimension.
     index_name : str, optional
         If given, the name of a coordinate to be added containing the
         index of where on the dimension the nearest value was found.
@@ -830,32 +2527,67 @@ def nearest(array: xr.DataArray,
         to the given target label.
     """
 
-    before_target = slice(None, target)
-    after_target = slice(target, None)
-
-    da_before = array.sel({dim: before_target})
-    da_after = array.sel({dim: after_target})
-
-    da_before = (last(da_before, dim, index_name) if
-                 da_before[dim].shape[0] else None)
-    da_after = (first(da_after, dim, index_name) if
-                da_after[dim].shape[0] else None)
-
-    if da_before is None and da_after is not None:
-        return da_after
-    if da_after is None and da_before is not None:
-        return da_before
-
-    target = array[dim].dtype.type(target)
-    is_before_closer = (abs(target - da_before[dim]) <
-                        abs(target - da_after[dim]))
-    nearest_array = xr.where(is_before_closer, da_before, da_after)
-    nearest_array[dim] = xr.where(is_before_closer,
-                                  da_before[dim],
-                                  da_after[dim])
-
-    if index_name is not None:
-        nearest_array[index_name] = xr.where(is_before_closer,
-                                             da_before[index_name],
-                                             da_after[index_name])
-    return nearest_array
+    if dask.is_dask_collection(array):
+        array = array.chunk({dim: -1})
+
+    coord = array[dim].values
+    n = len(coord)
+    single_target = np.ndim(target) == 0
+    targets = np.atleast_1d(np.asarray(target, dtype=coord.dtype))
+
+    # For every position along `dim`, find the closest non-null value at
+    # or before, and at or after that position. These are calculated in
+    # a single pass over the array and shared between all targets
+    previous_idx = _index_along(array, dim, _previous_valid_index,
+                                np.int32, keep_dim=True)
+    next_idx = _index_along(array, dim, _next_valid_index,
+                            np.int32, keep_dim=True)
+
+    def _closest(before, after, target, closest_position):
+        """
+        Chooses the closer of the previous and next non-null values.
+        """
+        before_missing = before < 0
+        after_missing = after >= n
+        dist_before = target - coord[np.clip(before, 0, n - 1)]
+        dist_after = coord[np.clip(after, 0, n - 1)] - target
+        use_before = ~before_missing & (after_missing |
+                                        (dist_before < dist_after))
+        idx = np.where(use_before, before, after)
+
+        # If no non-null values exist, use the position closest to the
+        # target instead
+        return np.where(before_missing & after_missing,
+                        closest_position, idx)
+
+    nearest_arrays = []
+    for target in targets:
+
+        # Positions of `target` (or the closest positions either side)
+        i_before = np.searchsorted(coord, target, side='right') - 1
+        i_after = np.searchsorted(coord, target, side='left')
+        before = (previous_idx.isel({dim: i_before}, drop=True)
+                  if i_before >= 0 else xr.full_like(previous_idx.isel(
+                      {dim: 0}, drop=True), -1))
+        after = (next_idx.isel({dim: i_after}, drop=True)
+                 if i_after < n else xr.full_like(next_idx.isel(
+                     {dim: 0}, drop=True), n))
+
+        # Position closest to `target`, used for all-null pixels
+        if i_before < 0 or (i_after < n and coord[i_after] - target <=
+                            target - coord[i_before]):
+            closest_position = min(i_after, n - 1)
+        else:
+            closest_position = i_before
+
+        idx = xr.apply_ufunc(_closest, before, after, target,
+                             closest_position,
+                             dask='parallelized',
+                             output_dtypes=[np.int32])
+        nearest_arrays.append(_reduce_by_index(array, dim, idx,
+                                               index_name))
+
+    # Return a single array if only one target was provided
+    if single_target:
+        return nearest_arrays[0]
+    return xr.concat(nearest_arrays, dim=pd.Index(targets, name='target'))
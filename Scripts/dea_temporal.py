@@ -26,28 +26,58 @@ Functions included:
     temporal_statistics
     time_buffer
     calculate_vector_stat
+    xr_vector_stat
     
 '''
 
 import sys
 import dask
+import warnings
 import numpy as np
 import xarray as xr
 import pandas as pd
 import hdstats
 import scipy.signal
-from scipy.signal import wiener
 from packaging import version
 from datacube.utils.geometry import assign_crs
 
 sys.path.append("../Scripts")
 
 
+def _nanarg_kernel(arr, stat="min", overwrite_input=False):
+    """
+    Calculates the index of the minimum or maximum value along the last
+    axis of an array, ignoring NaNs. All-NaN slices return -1. Indices
+    are returned as the smallest signed integer dtype able to hold them.
+
+    If `overwrite_input` is True, NaNs in `arr` are filled in place
+    rather than in a copy.
+    """
+    dtype = np.min_scalar_type(-arr.shape[-1])
+    argfunc = np.argmin if stat == "min" else np.argmax
+
+    if not np.issubdtype(arr.dtype, np.floating):
+        return np.asarray(argfunc(arr, axis=-1)).astype(dtype)
+
+    # Fill NaNs so they are never selected
+    nan_mask = np.isnan(arr)
+    fill = np.inf if stat == "min" else -np.inf
+    if overwrite_input:
+        np.copyto(arr, fill, where=nan_mask)
+        filled = arr
+    else:
+        filled = np.where(nan_mask, fill, arr)
+
+    idx = argfunc(filled, axis=-1)
+    return np.where(nan_mask.all(axis=-1), -1, idx).astype(dtype)
+
+
 def allNaN_arg(da, dim, stat):
     """
     Calculate da.argmax() or da.argmin() while handling
-    all-NaN slices. Fills all-NaN locations with an
-    float and then masks the offending cells.
+    all-NaN slices. All-NaN locations are returned as -1.
+    Computed in a single pass, and applied lazily
+    (chunk-by-chunk) to dask arrays.
 
     Params
     ------
@@ -60,70 +90,288 @@ def allNaN_arg(da, dim, stat):
     Returns
     ------
     xarray.DataArray
+        Integer indices, using the smallest integer dtype able to
+        hold them.
     """
-    # generate a mask where entire axis along dimension is NaN
-    mask = da.isnull().all(dim)
+    if stat not in ("min", "max"):
+        raise ValueError("stat should be either 'min' or 'max'")
+
+    # The reduced dimension must be a single chunk when using dask
+    if dask.is_dask_collection(da):
+        da = da.chunk({dim: -1})
+
+    return xr.apply_ufunc(_nanarg_kernel,
+                          da,
+                          input_core_dims=[[dim]],
+                          dask='parallelized',
+                          output_dtypes=[np.min_scalar_type(-da.sizes[dim])],
+                          kwargs=dict(stat=stat))
 
-    if stat == "max":
-        y = da.fillna(float(da.min() - 1))
-        y = y.argmax(dim=dim, skipna=True).where(~mask)
-        return y
 
-    if stat == "min":
-        y = da.fillna(float(da.max() + 1))
-        y = y.argmin(dim=dim, skipna=True).where(~mask)
-        return y
+def _fast_completion_kernel(arr):
+    """
+    Gap-fills an array along its last (time) axis by forward filling
+    NaNs with the last valid value, then filling any remaining leading
+    NaNs with the mean of the forward-filled series. All-NaN series
+    are left as NaN.
+    """
+    # Copy preserving memory layout; for data loaded as (time, y, x),
+    # each timestep remains a contiguous slice
+    filled = np.array(arr, order='K')
+
+    # Forward fill one timestep at a time across all pixels
+    for t in range(1, filled.shape[-1]):
+        np.copyto(filled[..., t], filled[..., t - 1],
+                  where=np.isnan(filled[..., t]))
+
+    # Fill leading NaNs with the nanmean of the forward-filled series
+    if np.isnan(filled[..., 0]).any():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            fill = np.nanmean(filled, axis=-1)
+        for t in range(filled.shape[-1]):
+            mask = np.isnan(filled[..., t])
+            if not mask.any():
+                break
+            filled[..., t][mask] = fill[mask]
+
+    return filled
 
 
 def fast_completion(da):
     """
     gap-fill a timeseries
+
+    Missing (NaN) values are forward filled with the last valid value
+    along the time dimension, and any NaNs at the start of a timeseries
+    are filled with the mean of the forward-filled timeseries. This is
+    applied to each pixel independently, so can be used on 1D
+    timeseries as well as 3D arrays, and is applied lazily
+    (chunk-by-chunk) to dask arrays.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        DataArray with a 'time' dimension to gap-fill.
+
+    Returns
+    -------
+    xarray.DataArray
+        The gap-filled DataArray, with 'time' as the last dimension
+        (e.g. `(y, x, time)`).
     """
-    if len(da.shape) == 1:
-        raise Exception("'fast_completion' does not currently operate on 1D timeseries")
-    # complete the timeseries (remove NaNs)
-    # grab coords etc
-    x, y, time, attrs = da.x, da.y, da.time, da.attrs
 
-    # reshape to satisfy function
-    da = da.transpose("y", "x", "time").values
-    
-    mask = np.isnan(da)
-    idx = np.where(~mask, np.arange(mask.shape[-1]), 0)
-    np.maximum.accumulate(idx, axis=-1, out=idx)
-    i, j = np.meshgrid(np.arange(idx.shape[0]),
-                       np.arange(idx.shape[1]),
-                       indexing="ij")
-    dat = da[i[:, :, np.newaxis], j[:, :, np.newaxis], idx]
-    if np.isnan(np.sum(dat[:, :, 0])):
-        fill = np.nanmean(dat, axis=-1)
-        for t in range(dat.shape[-1]):
-            mask = np.isnan(dat[:, :, t])
-            if mask.any():
-                dat[mask, t] = fill[mask]
-            else:
-                break
-                
-    #stack back into dataarray
-    dat = xr.DataArray(
-                dat,
-                attrs=attrs,
-                coords={
-                    "x": x,
-                    "y": y,
-                    "time": time
-                },
-                dims=["y", "x", "time"],
-            )
-    
-    return dat
+    # Time must be a single chunk when using dask
+    if dask.is_dask_collection(da):
+        da = da.chunk({'time': -1})
+
+    return xr.apply_ufunc(_fast_completion_kernel,
+                          da,
+                          input_core_dims=[['time']],
+                          output_core_dims=[['time']],
+                          dask='parallelized',
+                          output_dtypes=[da.dtype],
+                          keep_attrs=True)
+
+
+def _wiener_moments(arr, k):
+    """
+    Local mean and variance over a moving window of length `k` along
+    the last axis, calculated in the same way as `scipy.signal.wiener`
+    (i.e. with zero-padded edges) so that results are identical.
+    """
+    window = np.ones((1,) * (arr.ndim - 1) + (k,))
+    l_mean = scipy.signal.correlate(arr, window, 'same') / float(k)
+    l_var = (scipy.signal.correlate(arr ** 2, window, 'same') / float(k) -
+             l_mean ** 2)
+    return l_mean, l_var
+
+
+def _wiener_noise_kernel(arr, k=3, complete=False):
+    """
+    Local variance of a (optionally gap-filled) array, used to estimate
+    the Wiener filter noise power.
+    """
+    if complete:
+        arr = _fast_completion_kernel(arr)
+    return _wiener_moments(arr, k)[1]
+
+
+def _wiener_kernel(arr, noise, k=3, complete=False):
+    """
+    Wiener filter along the last axis of an array, equivalent to
+    `scipy.signal.wiener(arr, (1, ..., 1, k), noise)`. Like scipy,
+    results are returned as float64.
+    """
+    if complete:
+        arr = _fast_completion_kernel(arr)
+    l_mean, l_var = _wiener_moments(arr, k)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        res = arr - l_mean
+        res *= 1 - noise / l_var
+        res += l_mean
+    return np.where(l_var < noise, l_mean, res)
+
+
+def _savgol_kernel(arr, k=3, polyorder=1, complete=False):
+    """
+    Savitzky-Golay filter along the last axis of an array. Series
+    containing any NaNs (after optional gap-filling) are returned as
+    NaN.
+    """
+    if complete:
+        arr = _fast_completion_kernel(arr)
+    res = np.full(arr.shape, np.nan, dtype=arr.dtype)
+    finite = np.isfinite(arr).all(axis=-1)
+    if finite.any():
+        res[finite] = scipy.signal.savgol_filter(arr[finite], k, polyorder,
+                                                 axis=-1)
+    return res
+
+
+def _rolling_mean_kernel(arr, k=3, complete=False):
+    """
+    Trailing, NaN-aware rolling mean of length `k` along the last axis,
+    identical to `da.rolling(time=k, min_periods=1).mean()`.
+    """
+    if complete:
+        arr = _fast_completion_kernel(arr)
+    pad = [(0, 0)] * (arr.ndim - 1) + [(k - 1, 0)]
+    windows = np.lib.stride_tricks.sliding_window_view(
+        np.pad(arr, pad, constant_values=np.nan), k, axis=-1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanmean(windows, axis=-1)
+
+
+def _harmonic_kernel(arr, t, n_harmonics=2, complete=False):
+    """
+    Least-squares fit of a harmonic (Fourier) series with
+    `n_harmonics` annual harmonics to each series along the last axis.
+    Missing values are given zero weight in the fit.
+    """
+    if complete:
+        arr = _fast_completion_kernel(arr)
+
+    # Design matrix of shape (time, 2 * n_harmonics + 1)
+    omega = 2 * np.pi * t[:, None] * np.arange(1, n_harmonics + 1)
+    design = np.concatenate([np.ones((len(t), 1)), np.cos(omega),
+                             np.sin(omega)], axis=-1)
+
+    # Solve the weighted normal equations for all series at once
+    valid = ~np.isnan(arr)
+    values = np.where(valid, arr, 0)
+    lhs = np.einsum('...t,ti,tj->...ij', valid.astype(np.float64),
+                    design, design)
+    rhs = np.einsum('...t,ti->...i', values, design)
+    coefs = np.einsum('...ij,...j->...i', np.linalg.pinv(lhs), rhs)
 
-def smooth(da, k=3):
-    if len(da.shape) == 1:
-        raise Exception("'Smooth' does not currently operate on 1D timeseries")
-    da = da.transpose("y", "x", "time")
-    func = lambda arr, k: wiener(da, (1, 1, k))
-    return xr.apply_ufunc(func, da, k, dask='allowed')
+    res = np.einsum('...i,ti->...t', coefs, design)
+    res[~valid.any(axis=-1)] = np.nan
+    return res.astype(arr.dtype)
+
+
+def smooth(da, k=3, method='wiener', polyorder=1, n_harmonics=2,
+           complete=False):
+    """
+    Smooth a timeseries along the time dimension.
+
+    Each filter runs along 'time' independently for each pixel, so can
+    be used on 1D timeseries as well as 3D arrays, and is applied
+    lazily (chunk-by-chunk) to dask arrays without loading them into
+    memory.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        DataArray with a 'time' dimension to smooth.
+    k : int, optional
+        The window size of the filter (in timesteps). Defaults to 3.
+        Not used by the 'harmonic' method.
+    method : str, optional
+        The smoothing method to use. Options include:
+            'wiener' : scipy.signal.wiener style adaptive filter, with
+                the noise power estimated from the entire array.
+                Returns float64 data, like scipy.signal.wiener.
+            'savgol' : Savitzky-Golay filter of order `polyorder`.
+                Timeseries containing NaNs are returned as NaN, so
+                use `complete=True` to gap-fill them first.
+            'rolling_mean' : trailing rolling mean, equivalent to
+                da.rolling(time=k, min_periods=1).mean()
+            'harmonic' : least-squares fit of a harmonic series with
+                `n_harmonics` annual harmonics.
+        Defaults to 'wiener'.
+    polyorder : int, optional
+        The order of the polynomial used by the 'savgol' method. Must
+        be less than `k`. Defaults to 1.
+    n_harmonics : int, optional
+        The number of annual harmonics fitted by the 'harmonic' method.
+        Defaults to 2.
+    complete : bool, optional
+        If True, gap-fill the timeseries with fast_completion() in the
+        same pass as the smoothing. Defaults to False.
+
+    Returns
+    -------
+    xarray.DataArray
+        The smoothed DataArray, with 'time' as the last dimension
+        (e.g. `(y, x, time)`).
+    """
+
+    if method not in ('wiener', 'savgol', 'rolling_mean', 'harmonic'):
+        raise ValueError("method should be one of 'wiener', 'savgol', "
+                         "'rolling_mean' or 'harmonic'")
+
+    # Smoothed values are always floating point
+    if not np.issubdtype(da.dtype, np.floating):
+        da = da.astype(np.float32)
+
+    # Time must be a single chunk when using dask
+    if dask.is_dask_collection(da):
+        da = da.chunk({'time': -1})
+
+    args = [da]
+    kwargs = dict(complete=complete)
+    out_dtype = da.dtype
+
+    if method == 'wiener':
+        # Noise power is the mean local variance across the whole
+        # array; on dask arrays this remains a lazy reduction
+        noise = xr.apply_ufunc(_wiener_noise_kernel,
+                               da,
+                               input_core_dims=[['time']],
+                               output_core_dims=[['time']],
+                               dask='parallelized',
+                               output_dtypes=[np.float64],
+                               kwargs=dict(k=k, complete=complete)).mean()
+        func = _wiener_kernel
+        args.append(noise)
+        kwargs.update(k=k)
+        out_dtype = np.float64
+
+    elif method == 'savgol':
+        func = _savgol_kernel
+        kwargs.update(k=k, polyorder=polyorder)
+
+    elif method == 'rolling_mean':
+        func = _rolling_mean_kernel
+        kwargs.update(k=k)
+
+    elif method == 'harmonic':
+        # Time in decimal years since the first observation
+        t = ((da.time - da.time[0]) / np.timedelta64(1, 'D')) / 365.25
+        func = _harmonic_kernel
+        kwargs.update(t=t.data.astype(np.float64),
+                      n_harmonics=n_harmonics)
+
+    return xr.apply_ufunc(func,
+                          *args,
+                          input_core_dims=[['time']] + [[]] * (len(args) - 1),
+                          output_core_dims=[['time']],
+                          dask='parallelized',
+                          output_dtypes=[out_dtype],
+                          kwargs=kwargs,
+                          keep_attrs=True)
 
 
 def _vpos(da):
@@ -183,12 +431,11 @@ def _vsos(da, pos, method_sos="median"):
 
     if method_sos == "first":
         # find index (argmin) where distance is most negative
-        idx = allNaN_arg(distance, "time", "min").astype("int16")
+        idx = allNaN_arg(distance, "time", "min").clip(min=0)
 
     if method_sos == "median":
         # find index (argmin) where distance is smallest absolute value
-        idx = allNaN_arg(xr.ufuncs.fabs(distance), "time",
-                         "min").astype("int16")
+        idx = allNaN_arg(abs(distance), "time", "min").clip(min=0)
 
     return pos_greenup.isel(time=idx)
 
@@ -228,12 +475,11 @@ def _veos(da, pos, method_eos="median"):
 
     if method_eos == "last":
         # index where last negative slope occurs
-        idx = allNaN_arg(distance, "time", "min").astype("int16")
+        idx = allNaN_arg(distance, "time", "min").clip(min=0)
 
     if method_eos == "median":
         # index where median occurs
-        idx = allNaN_arg(xr.ufuncs.fabs(distance), "time",
-                         "min").astype("int16")
+        idx = allNaN_arg(abs(distance), "time", "min").clip(min=0)
 
     return neg_senesce.isel(time=idx)
 
@@ -275,6 +521,75 @@ def _ros(veos, vpos, eos, pos):
     return (veos - vpos) / (eos - pos)
 
 
+def _phenology_kernel(arr, doy, method_sos="median", method_eos="median"):
+    """
+    Calculates all phenology statistics in one pass over an array of
+    timeseries, where time is the last axis of `arr` and `doy` gives
+    the day of year of each timestep. Returns a dictionary of arrays
+    (one per statistic) with the time axis removed.
+
+    This gives the same results as combining `_vpos`, `_pos`, `_vsos`
+    etc, but shares intermediate results between statistics and avoids
+    creating many full-size temporary arrays.
+    """
+
+    timesteps = np.arange(arr.shape[-1])
+
+    # Peak and trough of season
+    vpos = np.nanmax(arr, axis=-1)
+    pos_idx = np.nanargmax(arr, axis=-1)
+    trough = np.nanmin(arr, axis=-1)
+
+    def _season_value(side, method):
+        # Index of the value closest to the median of the timesteps on
+        # one side of the peak (or the furthest below it if `method`
+        # is 'first' or 'last'). All-NaN series return an index of 0
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            distance = side - np.nanmedian(side, axis=-1, keepdims=True)
+        if method == "median":
+            np.abs(distance, out=distance)
+        idx = np.maximum(
+            _nanarg_kernel(distance, "min", overwrite_input=True), 0)
+        value = np.take_along_axis(side, idx[..., np.newaxis], axis=-1)
+        return value[..., 0], idx
+
+    # Start of season, using timesteps before the peak (greening)
+    greenup = np.where(timesteps < pos_idx[..., np.newaxis], arr, np.nan)
+    vsos, sos_idx = _season_value(greenup, method_sos)
+    del greenup
+
+    # End of season, using timesteps after the peak (senescing)
+    senesce = np.where(timesteps > pos_idx[..., np.newaxis], arr, np.nan)
+    veos, eos_idx = _season_value(senesce, method_eos)
+    del senesce
+
+    # Day of year statistics
+    pos = doy[pos_idx]
+    sos = doy[sos_idx]
+    eos = doy[eos_idx]
+    los = eos - sos
+    los = np.where(los >= 0, los, doy[-1] + los)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rog = (vpos - vsos) / (pos - sos)
+        ros = (veos - vpos) / (eos - pos)
+
+    return {
+        "SOS": sos.astype(np.int16),
+        "EOS": eos.astype(np.int16),
+        "vSOS": vsos.astype(np.float32),
+        "vPOS": vpos.astype(np.float32),
+        "Trough": trough.astype(np.float32),
+        "POS": pos.astype(np.int16),
+        "vEOS": veos.astype(np.float32),
+        "LOS": los.astype(np.int16),
+        "AOS": (vpos - trough).astype(np.float32),
+        "ROG": rog.astype(np.float32),
+        "ROS": ros.astype(np.float32),
+    }
+
+
 def xr_phenology(
     da,
     stats=[
@@ -307,7 +622,10 @@ def xr_phenology(
     ----------
     da :  xarray.DataArray
         DataArray should contain a 2D or 3D time series of a
-        vegetation index like NDVI, EVI
+        vegetation index like NDVI, EVI. If `da` has an integer
+        dtype and a `nodata` attribute (e.g. data loaded with
+        `load_ard(..., dtype='native')`), nodata pixels will be
+        treated as NaN.
     stats : list
         list of phenological statistics to return. Regardless of
         the metrics returned, all statistics are calculated
@@ -342,6 +660,8 @@ def xr_phenology(
         If 'wiener', the timeseries will be smoothed using the
         scipy.signal.wiener filter with a window size of 3.  If 'rolling_mean', 
         then timeseries is smoothed using a rolling mean with a window size of 3.
+        If 'savgol' or 'harmonic', the timeseries will be smoothed using a
+        Savitzky-Golay filter or a harmonic fit respectively (see smooth()).
         If set to 'linear', will be smoothed using da.resample(time='1W').interpolate('linear')
 
     Outputs
@@ -384,7 +704,7 @@ def xr_phenology(
                 complete=complete,
                 smoothing=smoothing,
             ),
-            template=xr.Dataset(template)
+            template=template
         )
         
         try:
@@ -403,6 +723,11 @@ def xr_phenology(
 
     # If stats supplied is not a list, convert to list.
     stats = stats if isinstance(stats, list) else [stats]
+
+    # Treat native nodata values as NaN if data is an integer dtype
+    nodata = da.attrs.get('nodata')
+    if nodata is not None and np.issubdtype(da.dtype, np.integer):
+        da = da.where(da != nodata)
     
     #try to grab the crs info
     try:
@@ -410,17 +735,16 @@ def xr_phenology(
     except:
         pass
     
-    # complete timeseries
+    # complete timeseries, fusing fast completion with the smoothing
+    # filter where possible so the data is only traversed once
+    fuse = (complete == 'fast_complete' and
+            smoothing in ('wiener', 'savgol', 'rolling_mean', 'harmonic'))
+
     if complete is not None:
         
         if complete=='fast_complete':
-            
-            if len(da.shape) == 1:
-                print("fast_complete does not operate on 1D timeseries, using 'linear' instead")
-                da = da.interpolate_na(dim='time', method='linear')
-                
-            else:
-                print("Completing using fast_complete...")
+            print("Completing using fast_complete...")
+            if not fuse:
                 da = fast_completion(da)
             
         if complete=='linear':
@@ -430,17 +754,20 @@ def xr_phenology(
     if smoothing is not None:
         
         if smoothing == "wiener":
-            if len(da.shape) == 1:
-                print("wiener method does not operate on 1D timeseries, using 'rolling_mean' instead")
-                da = da.rolling(time=3, min_periods=1).mean()
-            
-            else:
-                print("   Smoothing with wiener filter...")
-                da = smooth(da)
+            print("   Smoothing with wiener filter...")
+            da = smooth(da, method='wiener', complete=fuse)
             
         if smoothing == "rolling_mean":
             print("   Smoothing with rolling mean...")
-            da = da.rolling(time=3, min_periods=1).mean()
+            da = smooth(da, method='rolling_mean', complete=fuse)
+
+        if smoothing == "savgol":
+            print("   Smoothing with Savitzky-Golay filter...")
+            da = smooth(da, method='savgol', complete=fuse)
+
+        if smoothing == "harmonic":
+            print("   Smoothing with harmonic fit...")
+            da = smooth(da, method='harmonic', complete=fuse)
             
         if smoothing == 'linear':
             print("    Smoothing using linear interpolation...")
@@ -451,33 +778,21 @@ def xr_phenology(
     mask = da.isnull().all("time")
     da = da.where(~mask, other=0)
 
-    # calculate the statistics
+    # calculate all the statistics in a single pass over the data
     print("      Phenology...")
-    vpos = _vpos(da)
-    pos = _pos(da)
-    trough = _trough(da)
-    aos = _aos(vpos, trough)
-    vsos = _vsos(da, pos, method_sos=method_sos)
-    sos = _sos(vsos)
-    veos = _veos(da, pos, method_eos=method_eos)
-    eos = _eos(veos)
-    los = _los(da, eos, sos)
-    rog = _rog(vpos, vsos, pos, sos)
-    ros = _ros(veos, vpos, eos, pos)
+    da = da.transpose(..., "time")
+    results = _phenology_kernel(da.values,
+                                da.time.dt.dayofyear.values,
+                                method_sos=method_sos,
+                                method_eos=method_eos)
 
     # Dictionary containing the statistics
+    template = da.isel(time=0, drop=True)
     stats_dict = {
-        "SOS": sos.astype(np.int16),
-        "EOS": eos.astype(np.int16),
-        "vSOS": vsos.astype(np.float32),
-        "vPOS": vpos.astype(np.float32),
-        "Trough": trough.astype(np.float32),
-        "POS": pos.astype(np.int16),
-        "vEOS": veos.astype(np.float32),
-        "LOS": los.astype(np.int16),
-        "AOS": aos.astype(np.float32),
-        "ROG": rog.astype(np.float32),
-        "ROS": ros.astype(np.float32),
+        stat: xr.DataArray(results[stat],
+                           coords=template.coords,
+                           dims=template.dims)
+        for stat in stats
     }
 
     # intialise dataset with first statistic
@@ -494,14 +809,142 @@ def xr_phenology(
     except:
         pass
 
-    return ds.drop('time')
+    return ds
+
+
+_FOURIER_STATS = ("f_std", "f_median", "f_mean")
+
+
+def _temporal_stat_names(stats):
+    """
+    Expand a list of temporal statistics into output variable names,
+    with the Fourier statistics returning three layers each.
+    """
+    names = []
+    for stat in stats:
+        if stat in _FOURIER_STATS:
+            names += [stat + "_n1", stat + "_n2", stat + "_n3"]
+        else:
+            names.append(stat)
+    return names
+
+
+def _local_maxima(arr, n=10):
+    """
+    Counts the local maxima along the last axis of an array, where a
+    local maximum is a value strictly greater than all values within
+    `n` timesteps on either side. This is a fast alternative to the
+    wavelet-based `hdstats.number_peaks`, and gives different counts. The comparisons are made on zero-copy sliding window
+    views, so all series are processed simultaneously.
+    """
+    length = arr.shape[-1]
+    if length < 2 * n + 1:
+        return np.zeros(arr.shape[:-1], dtype=np.int8)
+
+    # Maximum of the n values before and after each candidate peak
+    windows = np.lib.stride_tricks.sliding_window_view(arr, n, axis=-1)
+    before = windows[..., :length - 2 * n, :].max(axis=-1)
+    after = windows[..., n + 1:, :].max(axis=-1)
+    centre = arr[..., n:length - n]
+
+    peaks = (centre > before) & (centre > after)
+    return peaks.sum(axis=-1).astype(np.int8)
+
+
+def _discordance(arr, n=10):
+    """
+    Equivalent to `hdstats.discordance`: the mean of each low-pass
+    filtered series minus the mean of the low-pass filtered magnitude
+    of the average series.
+
+    Low-pass filtering (zeroing Fourier coefficients from `n` onwards)
+    leaves the zero-frequency coefficient unchanged, so the mean of
+    each filtered series equals the mean of the original series and
+    the per-pixel Fourier transforms are not required.
+    """
+    reference = np.fft.fft(arr.mean(axis=tuple(range(arr.ndim - 1))))
+    reference[n:] = 0.0
+    reference = np.abs(np.fft.ifft(reference)).astype(np.float32)
+    return (arr.mean(axis=-1, dtype=np.float64) -
+            reference.mean(dtype=np.float64)).astype(np.float32)
+
+
+def _temporal_stats_kernel(arr, stats, n=3, step=5):
+    """
+    Calculates a set of temporal statistics for an array with
+    time as the last axis, in a single pass over the data. Intermediate
+    arrays (the Fourier spectrum and discrete differences) are computed
+    once and shared between all statistics that use them.
+
+    Returns a dictionary of statistic names to arrays with the time
+    axis removed, with the same values and dtypes as the equivalent
+    hdstats functions.
+    """
+    results = {}
+    dtype = arr.dtype
+
+    # Fourier spectrum magnitudes, shared by f_std, f_mean and f_median.
+    # For real input only half the spectrum needs to be computed; the
+    # remaining coefficients are the mirror image of the first half
+    if any(stat in _FOURIER_STATS for stat in stats):
+        length = arr.shape[-1]
+        spec = np.abs(np.fft.rfft(arr, axis=-1))
+        mirror = spec[..., 1:length - spec.shape[-1] + 1][..., ::-1]
+        spec = np.concatenate([spec, mirror], axis=-1)[..., :n * step + 1]
+        funcs = {"f_std": np.std, "f_mean": np.mean, "f_median": np.median}
+        for stat in _FOURIER_STATS:
+            if stat in stats:
+                for k in range(n):
+                    band = spec[..., 1 + k * step:(k + 1) * step + 1]
+                    results[f"{stat}_n{k + 1}"] = funcs[stat](
+                        band, axis=-1).astype(np.float32)
+
+    # Discrete differences along time, shared by the change statistics
+    if any(stat in ("mean_change", "median_change", "abs_change")
+           for stat in stats):
+        diff = np.diff(arr, axis=-1)
+        if "mean_change" in stats:
+            results["mean_change"] = np.mean(diff, axis=-1).astype(dtype)
+        if "median_change" in stats:
+            results["median_change"] = np.median(diff, axis=-1).astype(dtype)
+        if "abs_change" in stats:
+            np.abs(diff, out=diff)
+            results["abs_change"] = np.mean(diff, axis=-1).astype(dtype)
+        del diff
+
+    if "central_diff" in stats:
+        central = (arr[..., :-2] - 2 * arr[..., 1:-1] + arr[..., 2:]) / 2.0
+        results["central_diff"] = np.mean(central, axis=-1).astype(dtype)
+        del central
+
+    if "complexity" in stats:
+        z = np.diff(arr, axis=-1)
+        z /= np.std(arr, axis=-1, keepdims=True)
+        results["complexity"] = np.einsum("...k,...k->...", z, z).astype(
+            dtype)
+        del z
+
+    if "discordance" in stats:
+        results["discordance"] = _discordance(arr, n=10)
+
+    if "num_peaks" in stats:
+        results["num_peaks"] = hdstats.number_peaks(arr, 10)
+
+    if "num_local_maxima" in stats:
+        results["num_local_maxima"] = _local_maxima(arr, n=10)
+
+    return results
 
 
 def temporal_statistics(da, stats):
     """
-    Obtain generic temporal statistics using the hdstats temporal library:
-    https://github.com/daleroberts/hdstats/blob/master/hdstats/ts.pyx
+    Obtain generic temporal statistics, as defined by the hdstats temporal
+    library: https://github.com/daleroberts/hdstats/blob/master/hdstats/ts.pyx
     
+    All requested statistics are calculated together in a single pass
+    over each chunk of data, sharing intermediate results (e.g. the
+    Fourier transform) between statistics.
+
     last modified June 2020
     
     Parameters
@@ -511,7 +954,8 @@ def temporal_statistics(da, stats):
     stats : list
         list of temporal statistics to calculate.
         Options include:
-            'discordance' = 
+            'discordance' = mean of the low-pass filtered timeseries, relative to
+                            the low-pass filtered mean timeseries of all pixels
             'f_std' = std of discrete fourier transform coefficients, returns
                       three layers: f_std_n1, f_std_n2, f_std_n3
             'f_mean' = mean of discrete fourier transform coefficients, returns
@@ -525,6 +969,9 @@ def temporal_statistics(da, stats):
             'central_diff' = 
             'num_peaks' : The number of peaks in the timeseries, defined with a local
                           window of size 10.  NOTE: This statistic is very slow
+            'num_local_maxima' : The number of values in the timeseries greater than
+                                 all values within 10 timesteps either side. A fast
+                                 alternative to 'num_peaks', with different results
     Outputs
     -------
         xarray.Dataset containing variables for the selected 
@@ -540,34 +987,20 @@ def temporal_statistics(da, stats):
                 + "xarray v0.16, run da.compute() before passing dataArray."
             )
 
+        # If stats supplied is not a list, convert to list.
+        stats = stats if isinstance(stats, list) else [stats]
+
         # create a template that matches the final datasets dims & vars
-        arr = da.isel(time=0).drop("time")
-
-        # deal with the case where fourier is first in the list
-        if stats[0] in ("f_std", "f_median", "f_mean"):
-            template = xr.zeros_like(arr).to_dataset(name=stats[0] + "_n1")
-            template[stats[0] + "_n2"] = xr.zeros_like(arr)
-            template[stats[0] + "_n3"] = xr.zeros_like(arr)
-
-            for stat in stats[1:]:
-                if stat in ("f_std", "f_median", "f_mean"):
-                    template[stat + "_n1"] = xr.zeros_like(arr)
-                    template[stat + "_n2"] = xr.zeros_like(arr)
-                    template[stat + "_n3"] = xr.zeros_like(arr)
-                else:
-                    template[stat] = xr.zeros_like(arr)
-        else:
-            template = xr.zeros_like(arr).to_dataset(name=stats[0])
-
-            for stat in stats:
-                if stat in ("f_std", "f_median", "f_mean"):
-                    template[stat + "_n1"] = xr.zeros_like(arr)
-                    template[stat + "_n2"] = xr.zeros_like(arr)
-                    template[stat + "_n3"] = xr.zeros_like(arr)
-                else:
-                    template[stat] = xr.zeros_like(arr)
+        arr = da.isel(time=0, drop=True)
+        template = xr.Dataset({
+            name: arr.astype(np.int8 if name in ("num_peaks",
+                                                 "num_local_maxima") else
+                             np.float32 if name[:-3] in _FOURIER_STATS
+                             else da.dtype)
+            for name in _temporal_stat_names(stats)
+        })
         try:
-            template = template.drop('spatial_ref')
+            template = template.drop_vars('spatial_ref')
         except:
             pass
 
@@ -591,7 +1024,13 @@ def temporal_statistics(da, stats):
     stats = stats if isinstance(stats, list) else [stats]
     
     # grab all the attributes of the xarray
-    x, y, time, attrs = da.x, da.y, da.time, da.attrs
+    x, y, attrs = da.x, da.y, da.attrs
+
+    # try to grab the crs info
+    try:
+        crs = da.geobox.crs
+    except:
+        pass
 
     # deal with any all-NaN pixels by filling with 0's
     mask = da.isnull().all("time")
@@ -604,79 +1043,25 @@ def temporal_statistics(da, stats):
     # ensure dim order is correct for functions
     da = da.transpose("y", "x", "time").values
 
-    stats_dict = {
-        "discordance": lambda da: hdstats.discordance(da, n=10),
-        "f_std": lambda da: hdstats.fourier_std(da, n=3, step=5),
-        "f_mean": lambda da: hdstats.fourier_mean(da, n=3, step=5),
-        "f_median": lambda da: hdstats.fourier_median(da, n=3, step=5),
-        "mean_change": lambda da: hdstats.mean_change(da),
-        "median_change": lambda da: hdstats.median_change(da),
-        "abs_change": lambda da: hdstats.mean_abs_change(da),
-        "complexity": lambda da: hdstats.complexity(da),
-        "central_diff": lambda da: hdstats.mean_central_diff(da),
-        "num_peaks": lambda da: hdstats.number_peaks(da, 10),
-    }
-
+    # calculate all the statistics in a single pass over the data
     print("   Statistics:")
-    # if one of the fourier functions is first (or only)
-    # stat in the list then we need to deal with this
-    if stats[0] in ("f_std", "f_median", "f_mean"):
-        print("      " + stats[0])
-        stat_func = stats_dict.get(str(stats[0]))
-        zz = stat_func(da)
-        n1 = zz[:, :, 0]
-        n2 = zz[:, :, 1]
-        n3 = zz[:, :, 2]
-
-        # intialise dataset with first statistic
-        ds = xr.DataArray(
-            n1, attrs=attrs, coords={"x": x, "y": y}, dims=["y", "x"]
-        ).to_dataset(name=stats[0] + "_n1")
-
-        # add other datasets
-        for i, j in zip([n2, n3], ["n2", "n3"]):
-            ds[stats[0] + "_" + j] = xr.DataArray(
-                i, attrs=attrs, coords={"x": x, "y": y}, dims=["y", "x"]
-            )
-    else:
-        # simpler if first function isn't fourier transform
-        first_func = stats_dict.get(str(stats[0]))
-        print("      " + stats[0])
-        ds = first_func(da)
-
-        # convert back to xarray dataset
-        ds = xr.DataArray(
-            ds, attrs=attrs, coords={"x": x, "y": y}, dims=["y", "x"]
-        ).to_dataset(name=stats[0])
-
-    # loop through the other functions
-    for stat in stats[1:]:
+    for stat in stats:
         print("      " + stat)
-
-        # handle the fourier transform examples
-        if stat in ("f_std", "f_median", "f_mean"):
-            stat_func = stats_dict.get(str(stat))
-            zz = stat_func(da)
-            n1 = zz[:, :, 0]
-            n2 = zz[:, :, 1]
-            n3 = zz[:, :, 2]
-
-            for i, j in zip([n1, n2, n3], ["n1", "n2", "n3"]):
-                ds[stat + "_" + j] = xr.DataArray(
-                    i, attrs=attrs, coords={"x": x, "y": y}, dims=["y", "x"]
-                )
-
-        else:
-            # Select a stats function from the dictionary
-            # and add to the dataset
-            stat_func = stats_dict.get(str(stat))
-            ds[stat] = xr.DataArray(
-                stat_func(da), attrs=attrs, coords={"x": x, "y": y}, dims=["y", "x"]
+    results = _temporal_stats_kernel(da, stats)
+
+    # build the output dataset in one step
+    ds = xr.Dataset(
+        {
+            name: xr.DataArray(
+                results[name], attrs=attrs, coords={"x": x, "y": y},
+                dims=["y", "x"]
             )
+            for name in _temporal_stat_names(stats)
+        }
+    )
 
     # try to add back the geobox
     try:
-        crs = da.geobox.crs
         ds = assign_crs(ds, str(crs))
     except:
         pass
@@ -728,6 +1113,35 @@ def time_buffer(input_date, buffer='30 days', output_format='%Y-%m-%d'):
     return early_buffer, late_buffer
 
 
+def _vector_stat_kernel(
+    arr, stat, window_size=365, step=10, target_dim=365, window="hann"
+):
+    """
+    Applies a vectorised statistic over rolling windows along the last
+    axis of an array, for all series and windows at once.
+
+    Returns an array of shape `arr.shape[:-1] + (arr.shape[-1] // step,
+    target_dim)`, with rows for windows that do not fit in the series
+    left as zero (matching calculate_vector_stat).
+    """
+    length = arr.shape[-1]
+    out = np.zeros(arr.shape[:-1] + (length // step, target_dim))
+
+    # Zero-copy view of all windows starting every `step` timesteps
+    bases = range(0, length - window_size, step)
+    if len(bases) == 0:
+        return out
+    windows = np.lib.stride_tricks.sliding_window_view(
+        arr, window_size, axis=-1
+    )[..., : length - window_size : step, :]
+
+    # Apply the window function and statistic to every window at once
+    window = scipy.signal.get_window(window, window_size)
+    out[..., : len(bases), :] = stat(windows * window)
+
+    return out
+
+
 def calculate_vector_stat(
     vec: "data dim",
     stat: "data dim -> target dim",
@@ -736,15 +1150,20 @@ def calculate_vector_stat(
     target_dim=365,
     progress=None,
     window="hann",
+    vectorized=False,
 ):
     """Calculates a vector statistic over a rolling window.
     
     Parameters
     ----------
     vec : d-dimensional np.ndarray
-        Vector to calculate over, e.g. a time series.
+        Vector to calculate over, e.g. a time series. If `vectorized` is
+        True, this can also be a batch of vectors with time as the last
+        axis, e.g. an array of shape (pixel, time).
     stat : R^d -> R^t function
-        Statistic function.
+        Statistic function. If `vectorized` is True, this must operate
+        along the last axis of an array of windows (e.g.
+        `lambda x: np.abs(np.fft.fft(x, axis=-1))`).
     window_size : int
         Sliding window size (default 365).
     step : int
@@ -753,11 +1172,16 @@ def calculate_vector_stat(
         Dimensionality of the output of `stat` (default 365).
     progress : iterator -> iterator
         Optional progress decorator, e.g. tqdm.notebook.tqdm. Default None.
+        Not used if `vectorized` is True.
     window : str
         What kind of window function to use. Default 'hann', but you might
         also want to use 'boxcar'. Any scipy window
         function is allowed (see documentation for scipy.signal.get_window
         for more information).
+    vectorized : bool
+        If True, all windows are computed at once from a zero-copy sliding
+        window view of `vec`, and `stat` is called a single time on the
+        stacked windows. Default False.
         
     Returns
     -------
@@ -766,8 +1190,23 @@ def calculate_vector_stat(
     t-dimensional np.ndarray
         x values (the statistic axis)
     (d / step) x t-dimensional np.ndarray
-        The vector statistic array.
+        The vector statistic array. If `vectorized` is True, any leading
+        batch dimensions of `vec` are kept.
     """
+    length = vec.shape[-1] if vectorized else vec.shape[0]
+    y_values = np.linspace(0, length, length // step, endpoint=False)
+
+    if vectorized:
+        spectrogram_values = _vector_stat_kernel(
+            vec,
+            stat,
+            window_size=window_size,
+            step=step,
+            target_dim=target_dim,
+            window=window,
+        )
+        return y_values, np.arange(target_dim), spectrogram_values
+
     # Initialise output array.
     spectrogram_values = np.zeros((vec.shape[0] // step, target_dim))
 
@@ -786,7 +1225,84 @@ def calculate_vector_stat(
         spectrogram_values[base // step, :] = sad
 
     return (
-        np.linspace(0, vec.shape[0], vec.shape[0] // step, endpoint=False),
+        y_values,
         np.arange(target_dim),
         spectrogram_values,
-    )
\ No newline at end of file
+    )
+
+
+def xr_vector_stat(
+    da,
+    stat,
+    window_size=365,
+    step=10,
+    target_dim=365,
+    window="hann",
+    dim="time",
+    stat_dim="stat",
+):
+    """Calculates a vector statistic over a rolling window for every
+    pixel of an xarray.DataArray, e.g. a spectrogram of a whole raster.
+
+    All windows of all pixels in a chunk are computed at once (see
+    calculate_vector_stat with `vectorized=True`), and dask arrays are
+    processed lazily, chunk-by-chunk.
+    
+    Parameters
+    ----------
+    da : xarray.DataArray
+        DataArray with a `dim` dimension to calculate over.
+    stat : R^d -> R^t function
+        Vectorised statistic function, operating along the last axis of
+        an array of windows (e.g. `lambda x: np.abs(np.fft.fft(x, axis=-1))`).
+    window_size : int
+        Sliding window size (default 365).
+    step : int
+        Step size (default 10).
+    target_dim : int
+        Dimensionality of the output of `stat` (default 365).
+    window : str
+        What kind of window function to use. Default 'hann'. Any scipy
+        window function is allowed (see documentation for
+        scipy.signal.get_window for more information).
+    dim : str
+        The dimension to calculate over. Default 'time'.
+    stat_dim : str
+        The name of the new statistic dimension. Default 'stat'.
+        
+    Returns
+    -------
+    xarray.DataArray
+        The vector statistic array, with `dim` subsampled to the start of
+        each window and `stat_dim` as the last dimensions.
+    """
+    # The full series must be in a single chunk when using dask
+    if dask.is_dask_collection(da):
+        da = da.chunk({dim: -1})
+
+    length = da.sizes[dim]
+    result = xr.apply_ufunc(
+        _vector_stat_kernel,
+        da,
+        input_core_dims=[[dim]],
+        output_core_dims=[[dim, stat_dim]],
+        exclude_dims={dim},
+        dask="parallelized",
+        output_dtypes=[np.float64],
+        dask_gufunc_kwargs={
+            "output_sizes": {dim: length // step, stat_dim: target_dim}
+        },
+        kwargs=dict(
+            stat=stat,
+            window_size=window_size,
+            step=step,
+            target_dim=target_dim,
+            window=window,
+        ),
+    )
+
+    # Label each row with the start of its window
+    return result.assign_coords(
+        {dim: da[dim].values[::step][: length // step],
+         stat_dim: np.arange(target_dim)}
+    )
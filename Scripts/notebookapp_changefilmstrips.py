@@ -160,7 +160,7 @@ def run_filmstrip_app(output_name,
                  'gqa_iterative_mean_xy': [0, 1],
                  'cloud_cover': [0, max_cloud],
                  'resolution': resolution,
-                 'dask_chunks': {'time': 1, 'x': 2000, 'y': 2000},
+                 'dask_chunks': 'auto',
                  'align': (resolution[1] / 2.0, resolution[1] / 2.0)}
 
         # Load data from all three Landsats
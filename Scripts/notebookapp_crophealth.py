@@ -32,7 +32,6 @@ import ipywidgets as widgets
 # Load utility functions
 from dea_datahandling import load_ard
 from dea_spatialtools import transform_geojson_wgs_to_epsg
-from dea_bandindices import calculate_indices
 
 
 def load_crophealth_data():
@@ -42,8 +41,8 @@ def load_crophealth_data():
     Last modified: January 2020
 
     outputs
-    ds - data set containing combined, masked data from Sentinel-2a and -2b.
-    Masked values are set to 'nan'
+    ds - data set containing NDVI calculated from combined, masked data
+    from Sentinel-2a and -2b. Masked values are set to 'nan'
     """
     
     # Suppress warnings
@@ -71,25 +70,20 @@ def load_crophealth_data():
         'x': longitude,
         'y': latitude,
         'time': time,
-        'measurements': [
-            'nbar_red',
-            'nbar_green',
-            'nbar_blue',
-            'nbar_nir_1',
-            'nbar_swir_2',
-            'nbar_swir_3'
-        ],
         'output_crs': 'EPSG:3577',
         'resolution': (-10, 10)
     }
 
-    # Load the data and mask out bad quality pixels
-    ds_s2 = load_ard(dc, products=products, min_gooddata=0.5, **query)
-
-    # Calculate the normalised difference vegetation index (NDVI) across
-    # all pixels for each image.
-    # This is stored as an attribute of the data
-    ds_s2 = calculate_indices(ds_s2, index='NDVI', collection='ga_s2_1')
+    # Load the data, mask out bad quality pixels and calculate the
+    # normalised difference vegetation index (NDVI) across all pixels
+    # for each image. Only the NBAR bands needed to calculate NDVI are
+    # loaded
+    ds_s2 = load_ard(dc,
+                     products=products,
+                     min_gooddata=0.5,
+                     indices=['NDVI'],
+                     index_prefix='nbar',
+                     **query)
 
     # Return the data
     return(ds_s2)